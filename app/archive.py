@@ -0,0 +1,199 @@
+'''
+Cold-history tier. Older messages of long conversations, and every message of idle ones, are folded into
+a zlib-compressed JSON blob on the conversation (archived_messages) instead of staying in the plain BSON
+messages array. load_messages() puts the full history back together on read. The distinct words of the
+archived messages are kept uncompressed in archived_text, so that the text index still covers them.
+'''
+import asyncio
+import json
+import re
+import zlib
+from datetime import datetime, timedelta
+from typing import List, Optional
+from uuid import UUID
+
+import bson
+from pydantic import BaseModel, Field
+
+from models import ArchiveMetrics, ConversationFull, Prompt
+
+
+class MessageCountBackfill(BaseModel):
+    '''
+    Projection used to backfill message_count on conversations stored before it existed.
+    '''
+    id: UUID = Field(..., alias="_id")
+    messages: Optional[List[Prompt]] = None
+
+
+_WORD = re.compile(r"\w+")
+
+
+def archive_text(messages: List[Prompt]) -> str:
+    '''
+    Returns: the distinct words of messages in order of first use, for the text index. Mongo stems and
+    lowercases them itself, repeats would only make the document bigger.
+    '''
+    return " ".join(dict.fromkeys(word for m in messages for word in _WORD.findall(m.content.lower())))
+
+
+def pack_messages(messages: List[Prompt]) -> bytes:
+    payload = json.dumps([m.model_dump(mode="json") for m in messages], separators=(",", ":"))
+    return zlib.compress(payload.encode(), 9)
+
+
+def unpack_messages(blob: Optional[bytes]) -> List[Prompt]:
+    if not blob:
+        return []
+    return [Prompt(**m) for m in json.loads(zlib.decompress(blob))]
+
+
+def load_messages(convo) -> List[Prompt]:
+    '''
+    Takes in: a ConversationFull, or a projection of one that includes messages
+    Returns: the full history, archived messages first, as a new list
+    '''
+    return unpack_messages(getattr(convo, "archived_messages", None)) + list(convo.messages or [])
+
+
+def hydrate(convo):
+    '''
+    Rebuilds convo.messages in place for responses. Only use this on read paths, the result must not be
+    written back since the archived messages would then be stored twice.
+    '''
+    if getattr(convo, "archived_messages", None):
+        convo.messages = load_messages(convo)
+    return convo
+
+
+async def backfill_message_counts() -> int:
+    '''
+    Sets message_count on conversations stored before it existed. Runs once on startup, before any turn is
+    written, otherwise the $inc of a new turn would create the field with just that turn's messages.
+    Returns: the number of conversations updated.
+    '''
+    updated = 0
+    legacy = ConversationFull.find({"message_count": {"$exists": False}}).project(MessageCountBackfill)
+    async for convo in legacy:
+        result = await ConversationFull.find_one(
+            {"_id": convo.id, "message_count": {"$exists": False}, "messages": {"$size": len(convo.messages or [])}}
+        ).update({"$set": {ConversationFull.message_count: len(convo.messages or [])}})
+        if result and result.modified_count:
+            updated += 1
+    return updated
+
+
+class ArchiveCompactor:
+    '''
+    Background task that folds messages into the cold tier in batches.
+      keep_recent, messages that stay uncompressed on active conversations
+      min_fold, only compact an active conversation once this many messages can be folded
+      idle_seconds, conversations without a new turn for this long are folded completely
+      batch_size, conversations loaded per batch
+      rate, maximum conversations compacted per second
+      interval, seconds to sleep when there is nothing left to compact
+    '''
+
+    def __init__(
+        self,
+        keep_recent: int = 20,
+        min_fold: int = 20,
+        idle_seconds: float = 3 * 24 * 3600,
+        batch_size: int = 100,
+        rate: float = 50.0,
+        interval: float = 60.0,
+    ):
+        self.keep_recent = keep_recent
+        self.min_fold = min_fold
+        self.idle_seconds = idle_seconds
+        self.batch_size = batch_size
+        self.rate = rate
+        self.interval = interval
+
+    def candidates_query(self, now: datetime):
+        # both branches are served by the message_count and (updated_at, message_count) indexes, so an
+        # idle run doesn't scan the collection
+        cutoff = now - timedelta(seconds=self.idle_seconds)
+        return {
+            "$or": [
+                {"message_count": {"$gte": self.keep_recent + self.min_fold}},
+                {"updated_at": {"$lt": cutoff}, "message_count": {"$gt": 0}},
+                {"updated_at": None, "message_count": {"$gt": 0}},
+            ]
+        }
+
+    async def compact(self, convo: ConversationFull, now: datetime) -> Optional[dict]:
+        '''
+        Folds one conversation. Returns the metrics for it, or None if nothing was folded because the
+        conversation changed underneath us (it will be picked up again by a later batch).
+        '''
+        messages = convo.messages or []
+        idle = convo.updated_at is None or now - convo.updated_at >= timedelta(seconds=self.idle_seconds)
+        keep = 0 if idle else self.keep_recent
+        fold = len(messages) - keep
+        if fold <= 0:
+            return None
+
+        folded = messages[:fold]
+        archived = unpack_messages(convo.archived_messages) + folded
+        blob = pack_messages(archived)
+        text = archive_text(archived)
+        # only succeeds if no turn was appended and no other compactor ran since we loaded the conversation,
+        # conversations stored before archiving existed have no archived_count at all
+        archived_count = convo.archived_count or {"$in": [0, None]}
+        result = await ConversationFull.find_one(
+            {"_id": convo.id, "archived_count": archived_count, "messages": {"$size": len(messages)}}
+        ).update(
+            {
+                "$set": {
+                    ConversationFull.messages: messages[fold:],
+                    ConversationFull.message_count: len(messages) - fold,
+                    ConversationFull.archived_messages: blob,
+                    ConversationFull.archived_text: text,
+                    ConversationFull.archived_count: convo.archived_count + fold,
+                }
+            }
+        )
+        if not result or result.modified_count == 0:
+            return None
+        bytes_before = len(bson.encode({"messages": [m.model_dump(mode="json") for m in folded]}))
+        # the previous blob and text are replaced, so only the growth counts towards the archived size
+        bytes_after = len(blob) + len(text) - len(convo.archived_messages or b"") - len(convo.archived_text or "")
+        return {"messages": fold, "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+    async def run_batch(self) -> int:
+        '''
+        Compacts up to batch_size conversations and records metrics. Returns how many were compacted.
+        '''
+        now = datetime.utcnow()
+        batch = await ConversationFull.find(self.candidates_query(now)).limit(self.batch_size).to_list()
+        totals = {"conversations": 0, "messages": 0, "bytes_before": 0, "bytes_after": 0}
+        for convo in batch:
+            started = asyncio.get_running_loop().time()
+            stats = await self.compact(convo, now)
+            if stats is not None:
+                totals["conversations"] += 1
+                for key, value in stats.items():
+                    totals[key] += value
+            # spread the writes out so compaction does not compete with live traffic
+            remaining = 1 / self.rate - (asyncio.get_running_loop().time() - started)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+        if batch:
+            totals["reclaimed_bytes"] = totals["bytes_before"] - totals["bytes_after"]
+            await ArchiveMetrics.find_one({"_id": "compaction"}).upsert(
+                {"$inc": totals, "$set": {ArchiveMetrics.last_run: datetime.utcnow()}},
+                on_insert=ArchiveMetrics(**totals, last_run=datetime.utcnow()),
+            )
+        return totals["conversations"]
+
+    async def run_forever(self):
+        while True:
+            try:
+                compacted = await self.run_batch()
+            except Exception as e:
+                print(f"An error occurred while compacting conversations: {e}")
+                compacted = 0
+            if compacted == 0:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,214 @@
+'''
+Micro-benchmarks for the hot paths of a conversation request: model construction/validation, serialization,
+tokenization, archive (de)compression and the exception handlers. Runs offline against synthetic
+conversations and an in-memory mongomock database.
+
+Run from /app:
+  python -m benchmarks.bench --save benchmarks/baseline.json
+  python -m benchmarks.bench --compare benchmarks/baseline.json --threshold 0.25
+
+--compare exits with 1 if any benchmark got slower than the baseline by more than the threshold, or if a
+benchmark in the baseline was not run. Timings are only comparable on the same machine, so no baseline is
+committed: record one from the target branch on the machine that runs --compare, then compare the change.
+
+Tokenization and the exception handlers need main.py, which loads the tiktoken encoding. Without network
+access, point --tiktoken-cache (or TIKTOKEN_CACHE_DIR) at a directory holding the cached encoding. If main
+can't be imported the run fails, unless --allow-skip is given, in which case those benchmarks are left out.
+'''
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+from typing import Callable, Dict, List, Optional
+
+from beanie import init_beanie
+from fastapi.encoders import jsonable_encoder
+from mongomock_motor import AsyncMongoMockClient
+
+from archive import pack_messages, unpack_messages
+from models import ConversationFull
+
+SIZES = (10, 1000, 10000)
+
+
+def synthetic_conversation(size: int) -> dict:
+    '''
+    A conversation document as it comes out of Mongo, alternating user/assistant turns.
+    '''
+    messages = []
+    for i in range(size):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = f"Message {i}: " + "the quick brown fox jumps over the lazy dog " * (1 + i % 5)
+        messages.append({"role": role, "content": content})
+    return {
+        "name": f"Benchmark conversation ({size} messages)",
+        "params": {"temperature": 0.35},
+        "tokens": size * 20,
+        "messages": messages,
+    }
+
+
+def measure(func: Callable[[], object], repeat: int = 5) -> float:
+    '''
+    Returns: best seconds per call over `repeat` runs, with timeit choosing the number of calls per run.
+    '''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def load_main(allow_skip: bool = False):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")  # the client is created but never called
+    try:
+        import main
+    except Exception as e:
+        if not allow_skip:
+            raise SystemExit(
+                f"Could not import main, needed for the tokenization and exception handler benchmarks: {e}\n"
+                "Set --tiktoken-cache to a directory with the cached encoding, or pass --allow-skip"
+            )
+        print(f"Skipping tokenization and exception handler benchmarks, could not import main: {e}")
+        return None
+    return main
+
+
+def selected(name: str, sizes=SIZES, only: Optional[List[str]] = None) -> bool:
+    '''
+    Returns: whether the benchmark `name` is part of a run with these sizes and --only prefixes.
+    '''
+    if only and not any(name.startswith(prefix) for prefix in only):
+        return False
+    size = re.search(r"\[(\d+)\]$", name)
+    return size is None or int(size.group(1)) in sizes
+
+
+def handler_benchmarks(main) -> Dict[str, Callable[[], object]]:
+    from fastapi import HTTPException
+    from fastapi.exceptions import RequestValidationError
+    from starlette.requests import Request
+
+    request = Request({"type": "http", "method": "GET", "path": "/conversations/x", "headers": [], "query_string": b""})
+    validation_error = RequestValidationError(
+        [{"loc": ("path", "id"), "msg": "Input should be a valid UUID", "type": "uuid_parsing"}]
+    )
+    not_found = HTTPException(status_code=404, detail="Conversation not found")
+
+    # the handlers don't await anything, so driving the coroutine directly measures just the handler
+    def run(coro):
+        try:
+            coro.send(None)
+        except StopIteration as stop:
+            return stop.value
+
+    return {
+        "validation_exception_handler": lambda: run(main.validation_exception_handler(request, validation_error)),
+        "http_exception_handler": lambda: run(main.http_exception_handler(request, not_found)),
+    }
+
+
+def run_benchmarks(
+    sizes=SIZES, repeat: int = 5, only: Optional[List[str]] = None, allow_skip: bool = False
+) -> Dict[str, float]:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    db = AsyncMongoMockClient()["govtech_backend_benchmarks"]
+    loop.run_until_complete(init_beanie(database=db, document_models=[ConversationFull]))
+    main = load_main(allow_skip)
+
+    benchmarks: Dict[str, Callable[[], object]] = {}
+    for size in sizes:
+        raw = synthetic_conversation(size)
+        convo = ConversationFull.model_validate(raw)
+        blob = pack_messages(convo.messages)
+        contents = [m.content for m in convo.messages]
+        benchmarks[f"validate[{size}]"] = lambda raw=raw: ConversationFull.model_validate(raw)
+        benchmarks[f"model_dump[{size}]"] = lambda convo=convo: convo.model_dump()
+        benchmarks[f"model_dump_json[{size}]"] = lambda convo=convo: convo.model_dump_json()
+        # what FastAPI does for response_model routes, roughly
+        benchmarks[f"jsonable_encoder[{size}]"] = lambda convo=convo: json.dumps(jsonable_encoder(convo))
+        benchmarks[f"archive_pack[{size}]"] = lambda convo=convo: pack_messages(convo.messages)
+        benchmarks[f"archive_unpack[{size}]"] = lambda blob=blob: unpack_messages(blob)
+        if main is not None:
+            benchmarks[f"encode[{size}]"] = lambda contents=contents: [main.encoding.encode(c) for c in contents]
+    if main is not None:
+        benchmarks.update(handler_benchmarks(main))
+
+    results = {}
+    for name, func in benchmarks.items():
+        if not selected(name, sizes, only):
+            continue
+        # the exception handlers print every error, keep that cost but not the output
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results[name] = measure(func, repeat=repeat)
+        print(f"{name:40s} {results[name] * 1e6:14.2f} us")
+    loop.close()
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> List[str]:
+    '''
+    Returns: a description of every benchmark that is slower than the baseline by more than threshold
+    (0.25 = 25%), or that is in the baseline but missing from results. New benchmarks are ignored.
+    '''
+    regressions = [f"{name}: not run" for name in baseline if name not in results]
+    for name, seconds in results.items():
+        if name not in baseline or baseline[name] <= 0:
+            continue
+        ratio = seconds / baseline[name]
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {baseline[name] * 1e6:.2f} us -> {seconds * 1e6:.2f} us ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save", help="write results to this JSON baseline file")
+    parser.add_argument("--compare", help="compare results against this JSON baseline file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before failing")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES), help="conversation sizes")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per benchmark, best is kept")
+    parser.add_argument("--only", nargs="+", help="only run benchmarks starting with these names")
+    parser.add_argument("--tiktoken-cache", help="directory with the cached tiktoken encoding (TIKTOKEN_CACHE_DIR)")
+    parser.add_argument("--allow-skip", action="store_true", help="leave out benchmarks that need main.py if it fails")
+    args = parser.parse_args(argv)
+
+    if args.tiktoken_cache:
+        os.environ["TIKTOKEN_CACHE_DIR"] = args.tiktoken_cache
+    results = run_benchmarks(sizes=args.sizes, repeat=args.repeat, only=args.only, allow_skip=args.allow_skip)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "platform": platform.platform(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        # benchmarks left out with --sizes or --only are not missing
+        baseline = {name: seconds for name, seconds in baseline.items() if selected(name, args.sizes, args.only)}
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+'''
+Negotiated response compression. Starlette only ships a gzip middleware, so this picks the best
+encoding the client accepts out of zstd, br and gzip, depending on which libraries are installed.
+zstandard and brotli are optional, gzip is always available through zlib.
+'''
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+
+class _Compressor:
+    '''
+    Thin wrapper so every encoding exposes the same compress/flush interface as zlib.
+    '''
+
+    def __init__(self, compress: Callable[[bytes], bytes], flush: Callable[[], bytes]):
+        self.compress = compress
+        self.flush = flush
+
+
+def _gzip_compressor(level: int) -> _Compressor:
+    # wbits=31 writes the gzip header and trailer instead of a raw zlib stream
+    compressobj = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return _Compressor(compressobj.compress, compressobj.flush)
+
+
+def _brotli_compressor(level: int) -> _Compressor:
+    compressor = brotli.Compressor(quality=min(level, 11))
+    return _Compressor(compressor.process, compressor.finish)
+
+
+def _zstd_compressor(level: int) -> _Compressor:
+    compressobj = zstandard.ZstdCompressor(level=level).compressobj()
+    return _Compressor(compressobj.compress, compressobj.flush)
+
+
+# Server preference order, best ratio/speed trade-off first.
+COMPRESSORS: Dict[str, Callable[[int], _Compressor]] = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _zstd_compressor
+if brotli is not None:
+    COMPRESSORS["br"] = _brotli_compressor
+COMPRESSORS["gzip"] = _gzip_compressor
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    '''
+    Takes in: the raw Accept-Encoding header, e.g. "gzip;q=0.8, br"
+    Returns: a dict of encoding -> q-value. Malformed q-values are treated as 0.
+    '''
+    accepted = {}
+    for item in header.split(","):
+        parts = [part.strip() for part in item.split(";")]
+        coding = parts[0].lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def select_encoding(header: str, available: Optional[List[str]] = None) -> Optional[str]:
+    '''
+    Picks the encoding to use for a response, or None if the client does not accept any we support.
+    Ties on q-value are broken by server preference order.
+    '''
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    best, best_q = None, 0.0
+    for coding in available if available is not None else list(COMPRESSORS):
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class CompressionMiddleware:
+    '''
+    Compresses HTTP responses larger than minimum_size with the best encoding the client accepts.
+    WebSocket and lifespan traffic is passed through untouched.
+    '''
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 500, compresslevel: int = 6) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            encoding = select_encoding(Headers(scope=scope).get("Accept-Encoding", ""))
+            if encoding is not None:
+                responder = _CompressionResponder(self.app, encoding, self.minimum_size, self.compresslevel)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int, compresslevel: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.compressor = COMPRESSORS[encoding](compresslevel)
+        self.send: Optional[Send] = None
+        self.initial_message: Message = {}
+        self.started = False
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    def _set_headers(self, content_length: Optional[int]) -> None:
+        headers = MutableHeaders(raw=self.initial_message["headers"])
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if content_length is None:
+            del headers["Content-Length"]
+        else:
+            headers["Content-Length"] = str(content_length)
+
+    async def send_compressed(self, message: Message) -> None:
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # Hold the start message until we know whether the body is worth compressing.
+            self.initial_message = message
+            self.passthrough = "content-encoding" in Headers(raw=message["headers"])
+            return
+        if message_type != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.passthrough:
+            if not self.started:
+                self.started = True
+                await self.send(self.initial_message)
+            await self.send(message)
+            return
+
+        if not self.started:
+            self.started = True
+            if len(body) < self.minimum_size and not more_body:
+                self.passthrough = True
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+            if not more_body:
+                body = self.compressor.compress(body) + self.compressor.flush()
+                self._set_headers(len(body))
+            else:
+                body = self.compressor.compress(body)
+                self._set_headers(None)
+            await self.send(self.initial_message)
+        else:
+            body = self.compressor.compress(body)
+            if not more_body:
+                body += self.compressor.flush()
+
+        message["body"] = body
+        await self.send(message)
@@ -0,0 +1,134 @@
+'''
+Copy-on-write forks. Instead of a copy of the history, a fork stores its parent's id (parent_id) and how many
+of the parent's messages it shares (fork_point), and its own messages only hold the turns added after forking.
+Histories are append-only (compaction only moves messages into the cold tier), so the shared prefix never
+changes. When a parent is deleted, its forks get their own copy of the prefix first.
+'''
+from datetime import datetime
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from archive import archive_text, load_messages, pack_messages, unpack_messages
+from models import ConversationFull, Prompt
+from writebehind import TurnWriter
+
+
+def history_length(convo: ConversationFull, writer: TurnWriter) -> int:
+    '''
+    Returns: the number of messages in the full history of convo, without loading any of them.
+    '''
+    return (
+        convo.fork_point
+        + (convo.archived_count or 0)
+        + len(convo.messages or [])
+        + len(writer.pending_messages(convo))
+    )
+
+
+async def _load(id: UUID, cache: Dict[UUID, Optional[ConversationFull]]) -> Optional[ConversationFull]:
+    if id not in cache:
+        cache[id] = await ConversationFull.get(id)
+    return cache[id]
+
+
+async def fork_prefix(
+    convo, writer: TurnWriter, cache: Optional[Dict[UUID, Optional[ConversationFull]]] = None
+) -> List[Prompt]:
+    '''
+    Takes in:
+      convo, a ConversationFull, or a projection of one that includes parent_id and fork_point
+      cache, ancestors already loaded, pass the same dict when resolving many conversations
+    Returns: the messages convo shares with its ancestors, oldest first. Ancestors are only read as far up
+    the chain as messages are still needed.
+    Raises RuntimeError if an ancestor is missing, rather than returning an incomplete history.
+    '''
+    if cache is None:
+        cache = {}
+    parts = []
+    need = getattr(convo, "fork_point", 0) or 0
+    current = convo
+    while need > 0 and current.parent_id is not None:
+        parent = await _load(current.parent_id, cache)
+        if parent is None:
+            raise RuntimeError(f"Parent {current.parent_id} of conversation {current.id} not found")
+        from_ancestors = min(need, parent.fork_point)
+        own = load_messages(parent) + writer.pending_messages(parent)
+        parts.append(own[: need - from_ancestors])
+        need = from_ancestors
+        current = parent
+    return [m for part in reversed(parts) for m in part]
+
+
+async def resolve(convo, writer: TurnWriter, cache: Optional[Dict[UUID, Optional[ConversationFull]]] = None):
+    '''
+    Puts the shared prefix in front of convo.messages, in place. Read paths only, like archive.hydrate.
+    '''
+    if getattr(convo, "parent_id", None) is not None and getattr(convo, "messages", None) is not None:
+        convo.messages = await fork_prefix(convo, writer, cache) + list(convo.messages)
+    return convo
+
+
+async def fork_conversation(parent: ConversationFull, at: Optional[int], writer: TurnWriter) -> ConversationFull:
+    '''
+    Creates a fork sharing the first `at` messages of parent (all of them if at is None).
+    Raises ValueError if at is past the end of the parent's history, and LookupError if parent was deleted.
+    '''
+    length = history_length(parent, writer)
+    if at is None:
+        at = length
+    if at > length:
+        raise ValueError(f"Cannot fork at message {at}, the conversation only has {length} messages")
+    child = ConversationFull(
+        name=parent.name,
+        params=parent.params,
+        messages=[],
+        created_at=datetime.utcnow(),
+        parent_id=parent.id,
+        fork_point=at,
+    )
+    await child.insert()
+    # deleting the parent detaches its forks, then checks again once it is gone. Checking the parent after
+    # our insert means either that second check sees this fork or we see the parent gone.
+    if await ConversationFull.find({"_id": parent.id}).count() == 0:
+        await child.delete()
+        raise LookupError(f"Conversation {parent.id} was deleted while forking it")
+    return child
+
+
+async def detach_forks(parent: ConversationFull, writer: TurnWriter, attempts: int = 5) -> int:
+    '''
+    Gives every direct fork of parent its own copy of the shared prefix, so that parent can be deleted.
+    The prefix goes into the fork's cold tier, in front of anything already archived there, with the same
+    conditional update as compaction so that concurrent turns and compactions are not overwritten.
+    Returns: the number of forks detached.
+    '''
+    forks = await ConversationFull.find({"parent_id": parent.id}).to_list()
+    if not forks:
+        return 0
+    history = await fork_prefix(parent, writer) + load_messages(parent) + writer.pending_messages(parent)
+    for fork in forks:
+        for _ in range(attempts):
+            prefix = history[: fork.fork_point]
+            archived = prefix + unpack_messages(fork.archived_messages)
+            result = await ConversationFull.find_one(
+                {"_id": fork.id, "archived_count": fork.archived_count or {"$in": [0, None]}}
+            ).update(
+                {
+                    "$set": {
+                        ConversationFull.archived_messages: pack_messages(archived),
+                        ConversationFull.archived_text: archive_text(archived),
+                        ConversationFull.archived_count: len(archived),
+                        ConversationFull.parent_id: None,
+                        ConversationFull.fork_point: 0,
+                    }
+                }
+            )
+            if result and result.modified_count > 0:
+                break
+            # compacted in the meantime, try again with the new cold tier
+            fork = await ConversationFull.get(fork.id)
+            if fork is None:
+                break
+        else:
+            raise RuntimeError(f"Could not detach fork {fork.id} from conversation {parent.id}")
+    return len(forks)
@@ -0,0 +1,148 @@
+'''
+Request hedging for upstream completions. If the first attempt hasn't answered within a delay taken from
+a percentile of recent latencies, a second identical attempt is started. Whichever finishes first wins
+and the other one is cancelled. A cap on the share of hedged requests keeps the extra cost bounded.
+
+Latencies only compare between requests of the same kind, so whole completions and stream time to first
+chunk each get their own Hedger. They can share one HedgeBudget so that the cap holds across both.
+'''
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Deque, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class HedgeBudget:
+    '''
+    Caps the share of hedged requests.
+      window, number of recent requests the ratio is taken over
+      max_ratio, at most this share of the last `window` requests may be hedged
+    '''
+
+    def __init__(self, window: int = 1000, max_ratio: float = 0.05):
+        self.max_ratio = max_ratio
+        # one entry per recent request, True if it was hedged
+        self.hedged: Deque[bool] = deque(maxlen=window)
+        self.hedged_count = 0
+
+    def record(self, hedged: bool):
+        if len(self.hedged) == self.hedged.maxlen and self.hedged[0]:
+            self.hedged_count -= 1
+        self.hedged.append(hedged)
+        if hedged:
+            self.hedged_count += 1
+
+    def can_hedge(self) -> bool:
+        # counting this request as hedged, would we still be within budget?
+        return self.hedged_count + 1 <= self.max_ratio * max(len(self.hedged), 1)
+
+
+class Hedger:
+    '''
+      enabled, when False run() just awaits a single attempt
+      percentile, hedge once an attempt is slower than this percentile of recent latencies
+      window, number of recent latencies used for the percentile, and requests for the hedge ratio
+      min_samples, don't hedge until this many latencies have been observed
+      max_ratio, at most this share of the last `window` requests may be hedged
+      min_delay, never hedge sooner than this (seconds)
+      budget, a HedgeBudget shared with other Hedgers, replaces window and max_ratio for the hedge ratio
+    '''
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        percentile: float = 95.0,
+        window: int = 1000,
+        min_samples: int = 20,
+        max_ratio: float = 0.05,
+        min_delay: float = 0.05,
+        budget: Optional[HedgeBudget] = None,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.budget = budget or HedgeBudget(window, max_ratio)
+        self.hedges_won = 0
+
+    @property
+    def hedged_count(self) -> int:
+        return self.budget.hedged_count
+
+    def delay(self) -> Optional[float]:
+        '''
+        Returns: how long to wait before hedging, or None while there aren't enough samples yet.
+        '''
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return max(ordered[index], self.min_delay)
+
+    async def run(
+        self,
+        attempt: Callable[[], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+    ) -> T:
+        '''
+        Takes in:
+          attempt, starts one upstream request and returns its result
+          discard, called with the loser's result if both attempts finished, e.g. to close a stream
+        Returns: the result of whichever attempt finished first.
+        If one attempt fails while the other is still running, the other one is waited for.
+        '''
+        if not self.enabled:
+            return await attempt()
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        delay = self.delay()
+        tasks = [self._start(attempt)]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.budget.can_hedge():
+                self.budget.record(hedged=True)
+                tasks.append(self._start(attempt))
+            else:
+                self.budget.record(hedged=False)
+
+            winner = await self._first_success(tasks)
+            result = winner.result()
+            if winner is not tasks[0]:
+                self.hedges_won += 1
+            self.latencies.append(loop.time() - started)
+            return result
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    @staticmethod
+    def _start(attempt: Callable[[], Awaitable[T]]) -> asyncio.Task:
+        task = asyncio.ensure_future(attempt())
+        # the loser's error is never looked at, mark it retrieved so asyncio doesn't log it
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _first_success(self, tasks) -> asyncio.Task:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task in done and task.exception() is None:
+                    return task
+        # every attempt failed, surface the primary's error
+        return tasks[0]
+
+    def metrics(self) -> dict:
+        return {
+            "hedge_delay_seconds": self.delay(),
+            "hedged_requests": self.budget.hedged_count,
+            "window_requests": len(self.budget.hedged),
+            "hedges_won": self.hedges_won,
+        }
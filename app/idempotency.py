@@ -0,0 +1,136 @@
+'''
+Idempotency-Key support for POST /queries/{id}. The first request with a key claims it by inserting an
+IdempotencyRecord, runs, and stores its response. Retries get the stored response back without calling
+OpenAI again, and concurrent duplicates wait for the original to finish instead of starting their own.
+'''
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+from uuid import uuid4
+
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+from models import IdempotencyRecord
+
+COMPLETED = "completed"
+
+
+def fingerprint(body: str) -> str:
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    '''
+      wait_timeout, how long a duplicate waits for the original before giving up with a 409
+      lease_seconds, the original renews its claim on the key this often (times 3) while it runs. A claim that
+        wasn't renewed in time is treated as abandoned (e.g. the worker crashed) and can be taken over.
+    '''
+
+    def __init__(self, wait_timeout: float = 60.0, poll_interval: float = 0.1, lease_seconds: float = 30.0):
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        # requests in flight in this process, so local duplicates can wait without polling Mongo
+        self._inflight: Dict[str, asyncio.Event] = {}
+
+    async def run(
+        self, scope: str, key: str, body_fingerprint: str, func: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        '''
+        Takes in:
+          scope, the resource the key belongs to, so the same key can be reused across conversations
+          key, the client's Idempotency-Key header
+          body_fingerprint, hash of the request body
+          func, the actual request handler
+        Returns: the response of func, either freshly computed or stored by an earlier request.
+        '''
+        record_id = f"{scope}:{key}"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        while True:
+            try:
+                record = IdempotencyRecord(
+                    id=record_id, fingerprint=body_fingerprint, owner=uuid4().hex, lease_expires=self._lease_expiry()
+                )
+                await record.insert()
+            except DuplicateKeyError:
+                existing = await IdempotencyRecord.get(record_id)
+                if existing is None:
+                    # original failed or the record expired between our insert and get, try to claim it
+                    continue
+                if existing.fingerprint != body_fingerprint:
+                    raise HTTPException(
+                        status_code=422, detail="Idempotency-Key was already used with a different request body"
+                    )
+                if existing.status == COMPLETED:
+                    return existing.response
+                if await self._abandoned(existing):
+                    continue
+                if loop.time() >= deadline:
+                    raise HTTPException(
+                        status_code=409, detail="A request with this Idempotency-Key is still in progress"
+                    )
+                await self._wait(record_id, deadline - loop.time())
+                continue
+            return await self._execute(record, func)
+
+    def _lease_expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+
+    def _owned(self, record: IdempotencyRecord):
+        # every write after the claim is conditional on still owning the key, in case it was taken over
+        return IdempotencyRecord.find_one({"_id": record.id, "owner": record.owner})
+
+    async def _renew(self, record: IdempotencyRecord):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._owned(record).update({"$set": {IdempotencyRecord.lease_expires: self._lease_expiry()}})
+            except Exception as e:
+                print(f"An error occurred while renewing Idempotency-Key {record.id}: {e}")
+
+    async def _execute(self, record: IdempotencyRecord, func: Callable[[], Awaitable[Dict[str, Any]]]):
+        done = asyncio.Event()
+        self._inflight[record.id] = done
+        renewer = asyncio.create_task(self._renew(record))
+        try:
+            response = await func()
+            renewer.cancel()
+            await self._owned(record).update(
+                {"$set": {IdempotencyRecord.status: COMPLETED, IdempotencyRecord.response: response}}
+            )
+            return response
+        except BaseException:
+            renewer.cancel()
+            # free the key so that the client can retry a failed request
+            await self._owned(record).delete()
+            raise
+        finally:
+            self._inflight.pop(record.id, None)
+            done.set()
+
+    async def _wait(self, record_id: str, remaining: float):
+        done: Optional[asyncio.Event] = self._inflight.get(record_id)
+        if done is None:
+            # original is running on another worker, all we can do is poll
+            await asyncio.sleep(min(self.poll_interval, max(remaining, 0)))
+            return
+        try:
+            await asyncio.wait_for(done.wait(), timeout=max(remaining, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _abandoned(self, record: IdempotencyRecord) -> bool:
+        if record.id in self._inflight:
+            return False
+        # records written before leases existed only have created_at to go by
+        expires = record.lease_expires or record.created_at + timedelta(seconds=self.wait_timeout)
+        if datetime.utcnow() < expires:
+            return False
+        # only delete the claim we looked at, in case it was renewed or another request has taken it over since
+        await IdempotencyRecord.find_one(
+            {"_id": record.id, "owner": record.owner, "lease_expires": record.lease_expires}
+        ).delete()
+        return True
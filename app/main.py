@@ -1,10 +1,12 @@
-from fastapi import FastAPI, HTTPException, Path, Request
-from typing import List
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Path, Query, Request, WebSocket, WebSocketDisconnect
+from typing import AsyncIterator, List, Optional
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from dotenv import load_dotenv, find_dotenv
 from openai import AsyncOpenAI, OpenAIError
+from pydantic import ValidationError
 from models import (
     Conversation,
     ConversationFull,
@@ -19,9 +21,31 @@ from models import (
     InvalidParametersError,
     APIError,
     InvalidCreationError,
+    TooManyRequestsError,
+    IdempotencyRecord,
+    ArchiveMetrics,
+    StatsResponse,
+    SearchResponse,
+    DEFAULT_MODEL,
+    parse_fields,
+    conversation_projection,
 )
+from compression import CompressionMiddleware
+from idempotency import IdempotencyStore, fingerprint
+from stats import build_match, conversation_stats
+from archive import ArchiveCompactor, backfill_message_counts, hydrate, load_messages
+from sessions import ChatSessionCache
+from writebehind import TurnWriter
+from hedging import HedgeBudget, Hedger
+from search import create_backend
+from ratelimit import RateLimiter, RateLimitMiddleware, client_key, estimate_tokens, hash_key, retry_after_seconds
+from profiling import Profiler, ProfilingMiddleware
+from forks import detach_forks, fork_conversation, fork_prefix, resolve
+import asyncio
 import os
+import tempfile
 from uuid import UUID, uuid4
+from datetime import datetime
 import tiktoken
 from beanie import init_beanie, Document
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -33,6 +57,43 @@ from collections import defaultdict
 load_dotenv(find_dotenv())
 
 app = FastAPI()
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.getenv("COMPRESSION_MINIMUM_SIZE", "500")),
+    compresslevel=int(os.getenv("COMPRESSION_LEVEL", "6")),
+)
+rate_limit_enabled = os.getenv("RATE_LIMIT_ENABLED") == "True"
+# clients sending one of these keys get their own buckets, everyone else is limited by IP
+rate_limit_api_keys = frozenset(
+    hash_key(key.strip()) for key in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if key.strip()
+)
+# one request costs 1 token in the CRUD bucket, /queries costs the estimated prompt tokens in its own bucket
+crud_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_CRUD_RATE", "10")),
+    capacity=float(os.getenv("RATE_LIMIT_CRUD_BURST", "50")),
+    idle_seconds=float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "300")),
+    max_clients=int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000")),
+)
+query_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_QUERY_TOKENS_RATE", "100")),
+    capacity=float(os.getenv("RATE_LIMIT_QUERY_TOKENS_BURST", "4000")),
+    idle_seconds=float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "300")),
+    max_clients=int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "100000")),
+)
+if rate_limit_enabled:
+    # added last so it runs first, rejected requests never reach compression or the routes
+    app.add_middleware(RateLimitMiddleware, crud=crud_limiter, queries=query_limiter, api_keys=rate_limit_api_keys)
+profiling_enabled = os.getenv("PROFILING_ENABLED") == "True"
+profiler = Profiler(
+    output_dir=os.getenv("PROFILING_DIR", os.path.join(tempfile.gettempdir(), "govtech-profiles")),
+    token=os.getenv("PROFILING_TOKEN"),
+    sample_rate=float(os.getenv("PROFILING_SAMPLE_RATE", "0")),
+    interval=float(os.getenv("PROFILING_INTERVAL", "0.005")),
+    max_files=int(os.getenv("PROFILING_MAX_FILES", "1000")),
+)
+if profiling_enabled:
+    # outermost, so the profile covers everything down to the compressed response body
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
 
 
 @app.exception_handler(RequestValidationError)
@@ -60,19 +121,23 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     )
 
 
+def api_error(status_code: int, detail) -> APIError:
+    '''
+    Maps an HTTPException's status code and detail onto our APIError models.
+    '''
+    if status_code == 404:
+        return NotFoundError(details={"info": detail})  # by right i should dump the request in here but no time :(
+    elif status_code == 422:
+        return InvalidCreationError(details={"info": detail})
+    elif status_code == 500:
+        return InternalServerError(details={"info": detail})
+    # Fallback: return the default response for other HTTP errors
+    return APIError(code=status_code, message=detail)
+
+
 @app.exception_handler(StarletteHTTPException)
 async def http_exception_handler(request: Request, exc: StarletteHTTPException):
-    if exc.status_code == 404:
-        error_message = (
-            NotFoundError(details={"info": exc.detail})
-        )  # by right i should dump the request in here but no time :(
-    # Fallback: return the default response for other HTTP errors
-    elif exc.status_code == 422:
-        error_message = InvalidCreationError(details={"info": exc.detail})
-    elif exc.status_code == 500:
-        error_message = InternalServerError(details={"info": exc.detail})
-    else:
-        error_message = APIError(code=exc.status_code, message=exc.detail)
+    error_message = api_error(exc.status_code, exc.detail)
     print(error_message)
     return JSONResponse(
         status_code=error_message.code,
@@ -82,6 +147,49 @@ async def http_exception_handler(request: Request, exc: StarletteHTTPException):
 client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
 # count number of tokens used by conversation
 encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+idempotency_store = IdempotencyStore(
+    wait_timeout=float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "60")),
+    lease_seconds=float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "30")),
+)
+archive_compactor = ArchiveCompactor(
+    keep_recent=int(os.getenv("ARCHIVE_KEEP_RECENT", "20")),
+    min_fold=int(os.getenv("ARCHIVE_MIN_FOLD", "20")),
+    idle_seconds=float(os.getenv("ARCHIVE_IDLE_SECONDS", str(3 * 24 * 3600))),
+    batch_size=int(os.getenv("ARCHIVE_BATCH_SIZE", "100")),
+    rate=float(os.getenv("ARCHIVE_RATE", "50")),
+)
+turn_writer = TurnWriter(
+    enabled=os.getenv("WRITE_BEHIND_ENABLED") == "True",
+    max_batch=int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500")),
+    flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.05")),
+    max_pending=int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000")),
+)
+# whole completions and stream time to first chunk have separate latency windows but one hedge budget
+hedge_budget = HedgeBudget(max_ratio=float(os.getenv("HEDGE_MAX_RATIO", "0.05")))
+completion_hedger = Hedger(
+    enabled=os.getenv("HEDGE_ENABLED") == "True",
+    percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+    min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", "20")),
+    budget=hedge_budget,
+)
+stream_hedger = Hedger(
+    enabled=completion_hedger.enabled,
+    percentile=completion_hedger.percentile,
+    min_samples=completion_hedger.min_samples,
+    budget=hedge_budget,
+)
+chat_sessions = ChatSessionCache(
+    max_sessions=int(os.getenv("WS_MAX_SESSIONS", "1000")),
+    max_bytes=int(os.getenv("WS_MAX_CACHED_BYTES", str(64 * 1024 * 1024))),
+    idle_seconds=float(os.getenv("WS_IDLE_SECONDS", "300")),
+    writer=turn_writer,
+)
+# "mongo" uses the text index on conversations, "memory" an in-process BM25 index, see search.py
+search_backend = create_backend(os.getenv("SEARCH_BACKEND", "mongo"))
+turn_writer.listeners.append(lambda id, messages: search_backend.add_turn(id, messages))
+background_tasks = []
+# not cancelled on shutdown, see shutdown_event
+writer_tasks = []
 
 
 async def init_database():
@@ -93,12 +201,38 @@ async def init_database():
     db_client = AsyncIOMotorClient(os.environ["MONGODB_URL"])
 
     db = db_client["govtech_backend"]
-    await init_beanie(database=db, document_models=[ConversationFull])
+    await init_beanie(database=db, document_models=[ConversationFull, IdempotencyRecord, ArchiveMetrics])
 
 
 @app.on_event("startup")
 async def startup_event():
     await init_database()
+    # before serving, a turn written to a legacy conversation would create message_count with the wrong value
+    updated = await backfill_message_counts()
+    if updated:
+        print(f"Backfilled message_count on {updated} conversations")
+    background_tasks.append(asyncio.create_task(chat_sessions.run_sweeper()))
+    if os.getenv("ARCHIVE_ENABLED") == "True":
+        background_tasks.append(asyncio.create_task(archive_compactor.run_forever()))
+    if turn_writer.enabled:
+        writer_tasks.append(asyncio.create_task(turn_writer.run()))
+    if rate_limit_enabled:
+        background_tasks.append(asyncio.create_task(crud_limiter.run_sweeper()))
+        background_tasks.append(asyncio.create_task(query_limiter.run_sweeper()))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    # let a flush that is already writing finish instead of cancelling it halfway
+    turn_writer.stop()
+    await asyncio.gather(*writer_tasks, return_exceptions=True)
+    writer_tasks.clear()
+    # turns were already acknowledged to clients, write them before we exit
+    await turn_writer.drain()
 
 
 async def get_chatgpt_response(
@@ -111,17 +245,20 @@ async def get_chatgpt_response(
         params, the other params obtained from the user's conversation object
       Returns:
         Model Response as a Prompt object to add the conversation's messages field.
-      Currently params only accepts temperature, but could be modified to accept other parameters like
+      Currently params only accepts temperature and model, but could be modified to accept other parameters like
       max_tokens, response_format for fitting better to the Prompt model, user from the name field
       to track which person made which /queries completion.
     '''
     try:
         conversation_history.append(query_message)
         temp = params.get("temperature", 0.35)
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo-0125",
-            messages=conversation_history,
-            temperature=temp,
+        # hedger sends a second identical request if this one is unusually slow, see hedging.py
+        response = await completion_hedger.run(
+            lambda: client.chat.completions.create(
+                model=params.get("model", DEFAULT_MODEL),
+                messages=conversation_history,
+                temperature=temp,
+            )
         )
         model_role = response.choices[0].message.role
         model_response = response.choices[0].message.content
@@ -135,9 +272,74 @@ async def get_chatgpt_response(
         raise HTTPException(status_code=500, detail="An internal error occurred while fetching the ChatGPT response.")
 
 
+async def stream_chatgpt_response(
+    conversation_history: List[Prompt], query_message: Prompt, params
+) -> AsyncIterator[str]:
+    '''
+      Same as get_chatgpt_response, but yields the content of the model's response as it is generated.
+    '''
+    try:
+        conversation_history.append(query_message)
+        temp = params.get("temperature", 0.35)
+
+        async def open_stream():
+            # for streams the hedge is on time to first chunk rather than the whole response
+            stream = await client.chat.completions.create(
+                model=params.get("model", DEFAULT_MODEL),
+                messages=conversation_history,
+                temperature=temp,
+                stream=True,
+            )
+            try:
+                return stream, [await stream.__anext__()]
+            except StopAsyncIteration:
+                return stream, []
+            except BaseException:
+                await stream.close()
+                raise
+
+        async def close_stream(opened):
+            await opened[0].close()
+
+        stream, first = await stream_hedger.run(open_stream, discard=close_stream)
+        async with stream:
+            for chunk in first:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+    except OpenAIError as e:
+        raise HTTPException(status_code=422, detail=f"OpenAI API error: {e}")
+    except Exception as exc:
+        print(f"An error occurred: {exc}")
+        raise HTTPException(status_code=500, detail="An internal error occurred while fetching the ChatGPT response.")
+
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    health = {"status": "healthy"}
+    if turn_writer.enabled:
+        health["write_behind"] = turn_writer.metrics()
+    if completion_hedger.enabled:
+        health["hedging"] = {"completions": completion_hedger.metrics(), "streams": stream_hedger.metrics()}
+    if rate_limit_enabled:
+        health["rate_limit"] = {"crud": crud_limiter.metrics(), "queries": query_limiter.metrics()}
+    return health
+
+
+@app.get("/debug/profiles/{profile_id}", response_class=PlainTextResponse, include_in_schema=False)
+async def get_profile(profile_id: UUID, token: Optional[str] = Header(None, alias="X-Profile")):
+    """
+    Returns a profile written by ProfilingMiddleware as collapsed stacks, e.g. for flamegraph.pl or speedscope.
+    Needs the same X-Profile token used to request profiles, and looks like any other missing route otherwise.
+    """
+    if not profiling_enabled or not profiler.authorized(token):
+        raise HTTPException(status_code=404, detail="Not Found")
+    collapsed = await asyncio.to_thread(profiler.read, profile_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found: {profile_id}")
+    return PlainTextResponse(collapsed)
 
 
 @app.post(
@@ -195,33 +397,55 @@ async def health_check():
         },
     },
 )
-async def update_conversation_prompts(id: UUID, user_prompt: Prompt):
+async def update_conversation_prompts(
+    id: UUID,
+    user_prompt: Prompt,
+    idempotency_key: Optional[str] = Header(
+        None,
+        alias="Idempotency-Key",
+        max_length=255,
+        description="Retries with the same key return the original result instead of querying the model again",
+    ),
+):
     """
     Adds the user prompt and gpt response to ConversationFull object
     """
+    if idempotency_key is None:
+        return await append_prompt(id, user_prompt)
+    try:
+        return await idempotency_store.run(
+            scope=str(id),
+            key=idempotency_key,
+            body_fingerprint=fingerprint(user_prompt.model_dump_json()),
+            # the key is only completed once the turn is in Mongo, retries after a crash query again
+            func=lambda: append_prompt(id, user_prompt, durable=True),
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=f"An internal error occurred: {e}")
+
+
+async def append_prompt(id: UUID, user_prompt: Prompt, durable: bool = False):
     try:
         convo = await ConversationFull.get(id)
         if convo is None:
             raise HTTPException(status_code=404, detail=f"Conversation not found: {id} by /queries/id")
 
-        old_tokens = convo.tokens
         prompt_tokens = len(encoding.encode(user_prompt.content))
-        new_token_count = old_tokens + prompt_tokens
 
-        # send message to chatgpt
+        # send message to chatgpt, with the archived part of the history put back in front and any turns
+        # still waiting to be written behind it. Forks also get the prefix they share with their parent.
+        history = load_messages(convo) + turn_writer.pending_messages(convo)
         gpt_response = await get_chatgpt_response(
-            conversation_history=convo.messages,
+            conversation_history=await fork_prefix(convo, turn_writer) + history,
             query_message=user_prompt,
             params=convo.params,
         )
-        new_messages = convo.messages + [gpt_response]
 
-        await convo.set(
-            {
-                ConversationFull.messages: new_messages,
-                ConversationFull.tokens: new_token_count,
-            }
-        )
+        # only the new turn is written ($push), so a concurrent compaction can't be overwritten
+        await turn_writer.write(convo.id, [user_prompt, gpt_response], prompt_tokens, durable=durable)
 
         return {"id": str(convo.id)}
     except HTTPException:
@@ -269,14 +493,85 @@ async def create_conversation(convo: ConversationPOST):
     Returns: Convo UUID.
     """
     try:
-        convo_full = ConversationFull(**convo.dict(), messages=[])
+        convo_full = ConversationFull(**convo.dict(), messages=[], created_at=datetime.utcnow())
         res = await convo_full.insert()
         print(res)
+        await search_backend.add_conversation(convo_full.id, convo_full.name, [])
         return {"id": str(convo_full.id)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
 
+@app.post(
+    "/conversations/{id}/fork",
+    response_model=CreatedResponse,
+    status_code=201,
+    responses={
+        500: {
+            "model": InternalServerError,
+            "description": "Internal Server Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 500,
+                        "message": "Internal server error occurred",
+                    }
+                }
+            },
+        },
+        404: {
+            "model": NotFoundError,
+            "description": "Specified resource(s) was not found",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 404,
+                        "message": "Specified resource(s) was not found",
+                    }
+                }
+            },
+        },
+        400: {
+            "model": InvalidParametersError,
+            "description": "Invalid Parameters Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 400,
+                        "message": "Parameters were invalid for the endpoint.",
+                    }
+                }
+            },
+        },
+    },
+)
+async def create_fork(
+    id: UUID = Path(..., description="The UUID of the conversation to fork"),
+    at: Optional[int] = Query(None, ge=0, description="Number of messages to keep, defaults to the whole history"),
+):
+    """
+    Creates a new conversation that continues from the first `at` messages of this one.
+    The shared messages are not copied, the fork only stores its own turns. See forks.py.
+    """
+    try:
+        parent = await ConversationFull.get(id)
+        if parent is None:
+            raise HTTPException(status_code=404, detail=f"Conversation not found: {id} by /conversations/id/fork")
+        try:
+            child = await fork_conversation(parent, at, turn_writer)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        await search_backend.add_conversation(child.id, child.name, [])
+        return {"id": str(child.id)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"An error occurred while forking conversation: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
 @app.get(
     "/conversations",
     response_model=List[ConversationFull],
@@ -296,17 +591,125 @@ async def create_conversation(convo: ConversationPOST):
         },
     },
 )
-async def get_all_conversations():
+async def get_all_conversations(
+    fields: Optional[str] = Query(None, description="Comma-separated list of fields to return, e.g. name,tokens")
+):
     """
     Takes in: probably user header through JWT or smth haha
-    Returns: User's Conversation as a List
+    Returns: User's Conversation as a List, only with the requested fields if ?fields= is given
     """
     try:
+        requested = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        # forks of the same parent only load it once
+        parents = {}
+        if requested is not None:
+            projected = await ConversationFull.find().project(conversation_projection(requested)).to_list()
+            projected = [await resolve(turn_writer.apply_pending(hydrate(c)), turn_writer, parents) for c in projected]
+            # the projection also reads the fields needed to rebuild messages, only return what was asked for
+            return JSONResponse(content=jsonable_encoder(projected, include=set(requested)))
         conversations = await ConversationFull.find().to_list()
         if not conversations:
             return []  # Return an empty list if no conversations are found
-        return conversations
+        return [await resolve(turn_writer.apply_pending(hydrate(c)), turn_writer, parents) for c in conversations]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+@app.get(
+    "/stats",
+    response_model=StatsResponse,
+    status_code=200,
+    responses={
+        500: {
+            "model": InternalServerError,
+            "description": "Internal Server Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 500,
+                        "message": "Internal server error occurred",
+                    }
+                }
+            },
+        },
+        400: {
+            "model": InvalidParametersError,
+            "description": "Invalid Parameters Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 400,
+                        "message": "Parameters were invalid for the endpoint.",
+                    }
+                }
+            },
+        },
+    },
+)
+async def get_stats(
+    model: Optional[str] = Query(None, description="Only include conversations using this model"),
+    since: Optional[datetime] = Query(None, description="Only include conversations created at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only include conversations created before this time"),
+):
+    """
+    Returns token usage and history length totals, percentiles, and per-model / per-day breakdowns.
+    Everything is computed by a Mongo aggregation pipeline, no conversations are loaded here.
+    """
+    try:
+        return await conversation_stats(build_match(model=model, since=since, until=until))
     except Exception as e:
+        print(f"An error occurred while computing stats: {e}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+@app.get(
+    "/search",
+    response_model=SearchResponse,
+    status_code=200,
+    responses={
+        500: {
+            "model": InternalServerError,
+            "description": "Internal Server Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 500,
+                        "message": "Internal server error occurred",
+                    }
+                }
+            },
+        },
+        400: {
+            "model": InvalidParametersError,
+            "description": "Invalid Parameters Error",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "code": 400,
+                        "message": "Parameters were invalid for the endpoint.",
+                    }
+                }
+            },
+        },
+    },
+)
+async def search_conversations(
+    q: str = Query(..., min_length=1, description="Words to search for in conversation names and messages"),
+    page: int = Query(1, ge=1, description="Page number, starting at 1"),
+    page_size: int = Query(10, ge=1, le=50, description="Results per page"),
+):
+    """
+    Full-text search over conversation names and messages, best matches first.
+    Each result only has the conversation's id, name, score and a few snippets, never the whole history.
+    """
+    try:
+        total, hits = await search_backend.search(q, skip=(page - 1) * page_size, limit=page_size)
+        return {"total": total, "page": page, "page_size": page_size, "results": hits}
+    except Exception as e:
+        print(f"An error occurred while searching conversations: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
 
@@ -368,6 +771,8 @@ async def update_conversation(id: UUID, convo_update: ConversationPUT):
                 ConversationFull.params: convo_update.params,
             }
         )
+        if convo_update.name is not None:
+            await search_backend.rename(convo.id, convo_update.name)
         return {"id": str(convo.id)}
     except HTTPException:
         raise
@@ -407,17 +812,33 @@ async def update_conversation(id: UUID, convo_update: ConversationPUT):
         },
     },
 )
-async def get_conversation(id: UUID = Path(..., description="The UUID of the conversation to retrieve")):
+async def get_conversation(
+    id: UUID = Path(..., description="The UUID of the conversation to retrieve"),
+    fields: Optional[str] = Query(None, description="Comma-separated list of fields to return, e.g. name,tokens"),
+):
     """
     Retrieves the Conversation History by ID.
+    If ?fields= is given, only those fields are read from Mongo and returned.
     """
     try:
+        requested = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        if requested is not None:
+            projected = await ConversationFull.find_one({"_id": id}).project(
+                conversation_projection(requested)
+            )
+            if projected is None:
+                raise HTTPException(status_code=404, detail="Conversation not found")
+            projected = await resolve(turn_writer.apply_pending(hydrate(projected)), turn_writer)
+            return JSONResponse(content=jsonable_encoder(projected, include=set(requested)))
         print(type(id))
         convo = await ConversationFull.get(id)
         print(convo)
         if convo is None:
             raise HTTPException(status_code=404, detail="Conversation not found")
-        return convo
+        return await resolve(turn_writer.apply_pending(hydrate(convo)), turn_writer)
     except HTTPException:
         raise
     except Exception as e:
@@ -464,7 +885,12 @@ async def delete_conversation(id: UUID = Path(..., description="The UUID of the
         print(found_convo)
         if found_convo is None:
             raise HTTPException(status_code=404, detail=f"Conversation not found for DELETE /conversations/{id}")
+        # forks still share this conversation's messages, give them their own copy first
+        await detach_forks(found_convo, turn_writer)
         await found_convo.delete()
+        # forks created while we were detaching, see fork_conversation
+        await detach_forks(found_convo, turn_writer)
+        await search_backend.remove(found_convo.id)
     except HTTPException:
         raise
     except Exception as e:
@@ -472,6 +898,90 @@ async def delete_conversation(id: UUID = Path(..., description="The UUID of the
         raise HTTPException(status_code=500, detail=f"An internal error occurred while deleting the conversation{e}")
 
 
+async def send_websocket_error(websocket: WebSocket, status_code: int, detail):
+    error_message = api_error(status_code, detail)
+    print(error_message)
+    await websocket.send_json({"type": "error", "code": error_message.code, "message": error_message.message})
+
+
+@app.websocket("/ws/conversations/{id}")
+async def conversation_websocket(websocket: WebSocket, id: UUID):
+    """
+    Interactive chat over a WebSocket. The conversation is loaded once and kept in memory while the socket
+    is open, only new turns are written back.
+    Client sends: a Prompt as JSON, e.g. {"role": "user", "content": "hi"}
+    Server sends: {"type": "token", "content": ...} for every chunk of the reply, then
+      {"type": "done", "message": <Prompt>}, or {"type": "error", "code": ..., "message": ...}.
+      Prompts over the client's rate limit get a 429 error with "retry_after" in seconds.
+    """
+    await websocket.accept()
+    try:
+        session = await chat_sessions.acquire(id)
+    except Exception as e:
+        print(f"An error occurred while loading conversation: {e}")
+        await send_websocket_error(websocket, 500, "An internal error occurred while loading the conversation")
+        await websocket.close(code=1011)
+        return
+    if session is None:
+        await send_websocket_error(websocket, 404, f"Conversation not found: {id} by /ws/conversations/id")
+        await websocket.close(code=1008)
+        return
+
+    try:
+        while True:
+            data = await websocket.receive_text()
+            if rate_limit_enabled:
+                # each prompt draws from the same bucket as POST /queries/{id}
+                retry_after = query_limiter.take(
+                    client_key(websocket.scope, rate_limit_api_keys), estimate_tokens(len(data))
+                )
+                if retry_after > 0:
+                    error_message = TooManyRequestsError()
+                    print(error_message)
+                    await websocket.send_json(
+                        {
+                            "type": "error",
+                            "code": error_message.code,
+                            "message": error_message.message,
+                            "retry_after": retry_after_seconds(retry_after),
+                        }
+                    )
+                    continue
+            try:
+                user_prompt = Prompt.model_validate_json(data)
+            except ValidationError as e:
+                await send_websocket_error(websocket, 400, f"Invalid prompt: {e}")
+                continue
+
+            async with session.lock:
+                try:
+                    chunks = []
+                    async for chunk in stream_chatgpt_response(
+                        conversation_history=list(session.history),
+                        query_message=user_prompt,
+                        params=session.params,
+                    ):
+                        chunks.append(chunk)
+                        await websocket.send_json({"type": "token", "content": chunk})
+                    reply = Prompt(role=QueryRoleType.assistant, content="".join(chunks))
+                    prompt_tokens = len(encoding.encode(user_prompt.content))
+                    await chat_sessions.record_turn(session, user_prompt, reply, prompt_tokens)
+                except HTTPException as e:
+                    await send_websocket_error(websocket, e.status_code, e.detail)
+                    continue
+                except WebSocketDisconnect:
+                    raise
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+                    await send_websocket_error(websocket, 500, f"An internal error occurred: {e}")
+                    continue
+            await websocket.send_json({"type": "done", "message": reply.model_dump(mode="json")})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        chat_sessions.release(session)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,8 +1,12 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, create_model, model_validator
 from beanie import Document
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Type, FrozenSet
 from enum import Enum
 from uuid import uuid4, UUID
+from functools import lru_cache
+from datetime import datetime
+from pymongo import IndexModel, ASCENDING, TEXT
+import os
 
 class APIError(BaseModel):
     code: int = Field(..., description="API Error code associated with the error")
@@ -24,6 +28,9 @@ class NotFoundError(APIError):
 class InvalidCreationError(APIError):
     code: int = Field(422, description="API Error code associated with the error")
     message: str = Field("Unable to create resource due to errors", description="Error message associated with the error")
+class TooManyRequestsError(APIError):
+    code: int = Field(429, description="API Error code associated with the error")
+    message: str = Field("Too many requests, retry later", description="Error message associated with the error")
 class QueryRoleType(str, Enum):
     system = 'system'
     user = 'user'
@@ -34,14 +41,66 @@ class Prompt(BaseModel):
     role: QueryRoleType = Field(..., description="Chat roles for each individual message")
     content: str = Field(..., description="This is the prompt content of the message", format="text")
 
+# Used when a conversation's params do not override the model
+DEFAULT_MODEL = "gpt-3.5-turbo-0125"
+
 class Conversation(Document):
     id: UUID = Field(default_factory=uuid4, description="ID of the conversation", alias="_id")
     name: str = Field(..., description="Title of the conversation", max_length=200)
     params: Dict[str, Any] = Field(..., description="Parameter dictionary for overriding defaults prescribed by the AI Model")
     tokens: Optional[int] = Field(0, description="Total number of tokens consumed in this entire Chat", ge=0, readOnly=True)
+    created_at: Optional[datetime] = Field(None, description="When the conversation was created", readOnly=True)
 
 class ConversationFull(Conversation):
     messages: Optional[List[Prompt]] = Field(..., description="Chat messages to be included")
+    updated_at: Optional[datetime] = Field(None, description="When the last turn was added", readOnly=True)
+    # forks share a prefix of their parent's history instead of copying it, see forks.py
+    parent_id: Optional[UUID] = Field(None, description="ID of the conversation this one was forked from", readOnly=True)
+    fork_point: int = Field(0, description="Number of the parent's messages shared by this fork", ge=0, readOnly=True)
+    # cold tier, see archive.py. Never sent to clients, messages is rebuilt from it on read instead.
+    archived_messages: Optional[bytes] = Field(None, description="Compressed older messages", exclude=True)
+    archived_count: int = Field(0, description="Number of messages in archived_messages", exclude=True)
+    # the blob can't be indexed, its distinct words are kept next to it for the text index
+    archived_text: Optional[str] = Field(None, description="Distinct words of archived_messages", exclude=True)
+    # length of the plain messages array, kept in step with it so compaction can find candidates by index
+    message_count: int = Field(0, description="Number of messages in messages", exclude=True)
+    # ids of the latest write-behind flushes applied here, so that a retried flush is not applied twice
+    applied_flushes: List[str] = Field([], description="Recently applied write-behind flushes", exclude=True)
+
+    @model_validator(mode="after")
+    def default_message_count(self):
+        if "message_count" not in self.model_fields_set:
+            self.message_count = len(self.messages or [])
+        return self
+
+    class Settings:
+        indexes = [
+            IndexModel([("created_at", ASCENDING)]),
+            IndexModel([("message_count", ASCENDING)]),
+            IndexModel([("updated_at", ASCENDING), ("message_count", ASCENDING)]),
+            IndexModel([("parent_id", ASCENDING)]),
+            IndexModel(
+                [("name", TEXT), ("messages.content", TEXT), ("archived_text", TEXT)], name="conversation_text"
+            ),
+        ]
+
+class IdempotencyRecord(Document):
+    id: str = Field(..., description="Conversation id and Idempotency-Key of the original request", alias="_id")
+    fingerprint: str = Field(..., description="Hash of the original request body, to reject reused keys")
+    status: str = Field("in_progress", description="in_progress until the original request completes")
+    owner: Optional[str] = Field(None, description="Token of the request currently holding the key")
+    lease_expires: Optional[datetime] = Field(None, description="The owner is presumed dead after this, unless renewed")
+    response: Optional[Dict[str, Any]] = Field(None, description="Stored response body returned to retries")
+    created_at: datetime = Field(default_factory=datetime.utcnow, description="Used by the TTL index")
+
+    class Settings:
+        name = "idempotency_keys"
+        indexes = [
+            IndexModel(
+                [("created_at", ASCENDING)],
+                expireAfterSeconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400")),
+            )
+        ]
 
 class ConversationPOST(BaseModel):
     name: str = Field(..., description="Title of the conversation", max_length=200)
@@ -51,6 +110,50 @@ class ConversationPUT(BaseModel):
     name: Optional[str] = Field(None, description="Title of the conversation", max_length=200)
     params: Optional[Dict[str, Any]] = Field(None, description="Parameter dictionary for overriding defaults prescribed by the AI Model")
 
+class ArchiveMetrics(Document):
+    id: str = Field("compaction", description="Single metrics document for the compaction task", alias="_id")
+    conversations: int = Field(0, description="Conversations compacted")
+    messages: int = Field(0, description="Messages moved into the compressed tier")
+    bytes_before: int = Field(0, description="BSON size of the archived messages before compression")
+    bytes_after: int = Field(0, description="Size of the compressed blobs written")
+    reclaimed_bytes: int = Field(0, description="bytes_before - bytes_after")
+    last_run: Optional[datetime] = Field(None, description="When the last batch finished")
+
+    class Settings:
+        name = "archive_metrics"
+
+class UsageDistribution(BaseModel):
+    total: int = Field(0, description="Sum over all matching conversations")
+    avg: Optional[float] = Field(None, description="Mean per conversation")
+    p50: Optional[float] = Field(None, description="Median per conversation")
+    p90: Optional[float] = Field(None, description="90th percentile per conversation")
+    p99: Optional[float] = Field(None, description="99th percentile per conversation")
+
+class UsageBreakdown(BaseModel):
+    key: str = Field(..., description="Model name or day (YYYY-MM-DD) this row is grouped by")
+    conversations: int = Field(0, description="Number of conversations in this group")
+    tokens: int = Field(0, description="Total tokens consumed in this group")
+    messages: int = Field(0, description="Total messages in this group")
+
+class StatsResponse(BaseModel):
+    conversations: int = Field(0, description="Number of matching conversations")
+    tokens: UsageDistribution = Field(default_factory=UsageDistribution, description="Token usage per conversation")
+    messages: UsageDistribution = Field(default_factory=UsageDistribution, description="History length per conversation")
+    by_model: List[UsageBreakdown] = Field(default_factory=list, description="Usage grouped by model")
+    by_day: List[UsageBreakdown] = Field(default_factory=list, description="Usage grouped by creation day")
+
+class SearchHit(BaseModel):
+    id: UUID = Field(..., description="ID of the matching conversation")
+    name: str = Field(..., description="Title of the conversation")
+    score: float = Field(..., description="Relevance score, higher is better")
+    snippets: List[str] = Field(default_factory=list, description="Excerpts of the matching messages")
+
+class SearchResponse(BaseModel):
+    total: int = Field(..., description="Number of matching conversations")
+    page: int = Field(..., description="Page number, starting at 1")
+    page_size: int = Field(..., description="Results per page")
+    results: List[SearchHit] = Field(default_factory=list, description="Matching conversations, best first")
+
 class CreatedResponse(BaseModel):
     id: UUID = Field(..., description="Generated resource ID")
 
@@ -65,4 +168,43 @@ class ConversationPOST(BaseModel):
     params: Dict[str, Any] = Field(..., description="Parameter dictionary for overriding defaults prescribed by the AI Model")
 
 
-    
\ No newline at end of file
+# Fields that can be requested through ?fields=, id is always returned.
+CONVERSATION_FIELDS = (
+    "id", "name", "params", "tokens", "created_at", "updated_at", "parent_id", "fork_point", "messages"
+)
+
+
+def parse_fields(fields: Optional[str]) -> Optional[FrozenSet[str]]:
+    '''
+    Takes in: the raw comma-separated ?fields= query parameter
+    Returns: the requested field names, or None when every field should be returned.
+    Raises ValueError on unknown fields so that callers can turn it into a 400.
+    '''
+    if fields is None:
+        return None
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = requested - set(CONVERSATION_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields requested: {', '.join(sorted(unknown))}")
+    return frozenset(requested | {"id"})
+
+
+@lru_cache(maxsize=None)
+def conversation_projection(fields: FrozenSet[str]) -> Type[BaseModel]:
+    '''
+    Builds (and caches) a projection model with only the requested ConversationFull fields. Beanie
+    turns the model's fields into a Mongo projection, so unrequested fields are never read or validated.
+    '''
+    if "messages" in fields:
+        # archived messages and the fork's parent are needed to rebuild the full history
+        fields = fields | {"archived_messages", "archived_count", "parent_id", "fork_point"}
+    if fields & {"messages", "tokens", "updated_at"}:
+        # write-behind turns this document already holds, see TurnWriter.apply_pending
+        fields = fields | {"applied_flushes"}
+    model_fields = {
+        name: (field.annotation, field)
+        for name, field in ConversationFull.model_fields.items()
+        if name in fields
+    }
+    name = "ConversationProjection_" + "_".join(sorted(fields))
+    return create_model(name, **model_fields)
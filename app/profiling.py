@@ -0,0 +1,211 @@
+'''
+On-demand request profiling. A request is profiled when it carries the X-Profile header with the configured
+token, or is picked at random with sample_rate. Profiled requests are sampled from a background thread
+and written out as collapsed stacks ("frame;frame;frame count" per line) that flamegraph.pl, speedscope
+and most other flamegraph tools read directly. The response gets an X-Profile-Id header naming the file.
+
+Samples are taken of the request's own task, so they cover the Beanie load, tokenization, the upstream wait
+and serialization but not other requests running concurrently. While the task is running its stack is
+taken from the thread, while it is suspended its awaited coroutine chain is recorded with a "[waiting]"
+leaf, so time spent waiting on Mongo or OpenAI shows up under the line that awaited it.
+
+Profiles are written from a worker thread so the event loop isn't blocked on disk, and only the newest
+max_files are kept.
+
+The middleware is only installed when profiling is enabled, so there is no overhead at all otherwise.
+'''
+import asyncio
+import hmac
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from typing import List, Optional
+from uuid import UUID, uuid4
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+PROFILE_SUFFIX = ".folded"
+
+
+def _label(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    # ; separates frames and spaces separate the count in the collapsed format
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":").replace(" ", "_")
+
+
+def _awaited_frames(coro) -> list:
+    '''
+    Returns: the frames of a suspended coroutine and of everything it is awaiting, outermost first.
+    Task.get_stack() only returns the outermost one.
+    '''
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            # a Future or other awaitable without a frame, the chain ends here
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+
+class StackSampler:
+    '''
+    Samples one asyncio task every `interval` seconds from a background thread.
+    '''
+
+    def __init__(self, task: asyncio.Task, interval: float = 0.005):
+        self.task = task
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stack = self.sample()
+            # the last sample can land in stop() itself
+            if stack and not self._stop.is_set():
+                self.counts[";".join(stack)] += 1
+
+    def sample(self) -> List[str]:
+        coro = self.task.get_coro()
+        if getattr(coro, "cr_running", False):
+            # on CPU, keep the thread's stack from the task's outermost coroutine down
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame)
+                if frame is coro.cr_frame:
+                    break
+                frame = frame.f_back
+            return [_label(f.f_code) for f in reversed(stack)]
+        # suspended, record what it is waiting on
+        frames = _awaited_frames(coro)
+        if not frames:
+            return []
+        return [_label(f.f_code) for f in frames] + ["[waiting]"]
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+class Profiler:
+    '''
+      output_dir, where profiles are written, one file per request
+      token, requests with "X-Profile: <token>" are profiled. Header profiling is off if this is empty.
+      sample_rate, share of all other requests that are profiled, 0 to only profile on request
+      interval, seconds between samples
+      max_active, requests profiled at the same time, others just run unprofiled
+      max_files, profiles kept in output_dir, the oldest are deleted once there are more
+    '''
+
+    def __init__(
+        self,
+        output_dir: str,
+        token: Optional[str] = None,
+        sample_rate: float = 0.0,
+        interval: float = 0.005,
+        max_active: int = 2,
+        max_files: int = 1000,
+    ):
+        self.output_dir = output_dir
+        self.token = token
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_active = max_active
+        self.max_files = max_files
+        self.active = 0
+
+    def authorized(self, value: Optional[str]) -> bool:
+        return bool(self.token) and value is not None and hmac.compare_digest(value, self.token)
+
+    def should_profile(self, scope: Scope) -> bool:
+        if self.active >= self.max_active:
+            return False
+        if self.authorized(Headers(scope=scope).get("X-Profile")):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def path(self, profile_id: UUID) -> str:
+        return os.path.join(self.output_dir, profile_id.hex + PROFILE_SUFFIX)
+
+    def read(self, profile_id: UUID) -> Optional[str]:
+        try:
+            with open(self.path(profile_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, profile_id: UUID, collapsed: str):
+        '''
+        Blocking, run it in a thread.
+        '''
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path(profile_id), "w") as f:
+            f.write(collapsed)
+        self.prune()
+
+    def prune(self) -> int:
+        '''
+        Deletes the oldest profiles beyond max_files. Returns how many were deleted.
+        '''
+        profiles = []
+        for entry in os.scandir(self.output_dir):
+            if entry.name.endswith(PROFILE_SUFFIX):
+                try:
+                    profiles.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    # deleted by a concurrent prune
+                    continue
+        deleted = 0
+        for _, path in sorted(profiles)[: max(len(profiles) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp, profiler: Profiler) -> None:
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.profiler.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid4()
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(raw=message["headers"])["X-Profile-Id"] = str(profile_id)
+            await send(message)
+
+        sampler = StackSampler(asyncio.current_task(), self.profiler.interval)
+        self.profiler.active += 1
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            self.profiler.active -= 1
+            try:
+                await asyncio.to_thread(self.profiler.write, profile_id, sampler.collapsed())
+                print(f"Wrote profile {profile_id} for {scope['method']} {scope['path']}")
+            except OSError as e:
+                print(f"An error occurred while writing profile {profile_id}: {e}")
@@ -0,0 +1,224 @@
+'''
+In-process token-bucket rate limiting per client. Clients are identified by their API key (X-API-Key or
+Authorization header) if it is one of the configured keys, and otherwise by IP, so that made-up keys can't
+be used to get fresh buckets. Keys are only kept as hashes. POST /queries/{id} draws from its own bucket,
+weighted by an estimate of the prompt's tokens, every other route costs 1 from the CRUD bucket. Buckets
+refill lazily when they are checked, so a check is O(1), and buckets that have been idle long enough to be
+full again are dropped by sweep(). At most max_clients buckets are kept, the least recently used go first.
+'''
+import asyncio
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, FrozenSet, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from models import TooManyRequestsError
+
+# routes that are never limited, so that health checks keep working for throttled clients
+EXEMPT_PATHS = ("/health",)
+
+
+def estimate_tokens(content_length: int) -> int:
+    '''
+    Rough prompt size from the request body, about 4 bytes per token. Good enough for weighting, and unlike
+    tiktoken it doesn't need the body to be read and parsed before the request is let through.
+    '''
+    return max(1, content_length // 4)
+
+
+def retry_after_seconds(retry_after: float) -> int:
+    # whole seconds, rounded up so that a client waiting this long is let through
+    return max(1, math.ceil(retry_after))
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    '''
+    One token bucket per client key.
+      rate, tokens added per second
+      capacity, bucket size, i.e. the largest burst allowed
+      idle_seconds, buckets unused for this long are evicted by sweep(). Never less than the time an empty
+        bucket takes to refill, so evicting a bucket never gives a client more than a full one.
+      max_clients, buckets kept at most, the least recently used one is evicted to make room for a new one
+    '''
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+        idle_seconds: float = 300.0,
+        max_clients: int = 100000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.idle_seconds = max(idle_seconds, capacity / rate)
+        self.max_clients = max_clients
+        self.clock = clock
+        # least recently used first, so sweep() can stop at the first bucket that is still in use
+        self._buckets: "OrderedDict[str, _Bucket]" = OrderedDict()
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        '''
+        Takes cost tokens from key's bucket if it has them.
+        Returns: 0 if the request is allowed, otherwise the seconds until it would be.
+        '''
+        now = self.clock()
+        # a request bigger than the bucket could never go through, charge it a full bucket instead
+        cost = min(cost, self.capacity)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.capacity, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0.0
+        self.rejected += 1
+        return (cost - bucket.tokens) / self.rate
+
+    def sweep(self) -> int:
+        '''
+        Evicts idle buckets. Returns how many were evicted.
+        '''
+        cutoff = self.clock() - self.idle_seconds
+        evicted = 0
+        while self._buckets:
+            key, bucket = next(iter(self._buckets.items()))
+            if bucket.updated >= cutoff:
+                break
+            del self._buckets[key]
+            evicted += 1
+        return evicted
+
+    async def run_sweeper(self, interval: float = 60.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def metrics(self) -> dict:
+        return {"clients": len(self._buckets), "rejected": self.rejected}
+
+
+def hash_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def client_key(scope: Scope, api_keys: FrozenSet[str] = frozenset()) -> str:
+    '''
+    Takes in: the request scope, and hash_key() of every API key that gets its own bucket
+    Returns: the bucket key, the hashed API key if it is a configured one, otherwise the client's IP
+    '''
+    headers = Headers(scope=scope)
+    api_key = headers.get("X-API-Key") or headers.get("Authorization", "").removeprefix("Bearer ")
+    if api_key:
+        hashed = hash_key(api_key)
+        if hashed in api_keys:
+            return "key:" + hashed
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+
+class RateLimitMiddleware:
+    '''
+    Rejects requests over the client's limit with 429, a Retry-After header and the usual APIError body.
+      crud, limiter for every route except POST /queries/{id}, one token per request or WebSocket connection
+      queries, limiter for POST /queries/{id}, weighted by estimate_tokens of the request body. Prompts sent
+        over a WebSocket are charged to it by the WebSocket route itself.
+      api_keys, hash_key() of the API keys that are limited per key rather than per IP
+    '''
+
+    def __init__(
+        self, app: ASGIApp, crud: RateLimiter, queries: RateLimiter, api_keys: FrozenSet[str] = frozenset()
+    ) -> None:
+        self.app = app
+        self.crud = crud
+        self.queries = queries
+        self.api_keys = api_keys
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket") or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        key = client_key(scope, self.api_keys)
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"].startswith("/queries/"):
+            length, receive = await _content_length(scope, receive)
+            retry_after = self.queries.take(key, estimate_tokens(length))
+        else:
+            retry_after = self.crud.take(key)
+
+        if retry_after == 0:
+            await self.app(scope, receive, send)
+        elif scope["type"] == "websocket":
+            # closing before accept makes the server answer the handshake with 403
+            await send({"type": "websocket.close", "code": 1008})
+        else:
+            await _reject(scope, receive, send, retry_after)
+
+
+async def _content_length(scope: Scope, receive: Receive) -> Tuple[int, Receive]:
+    '''
+    Returns: the size of the request body, and the receive callable the app should use. The body is only
+    read up front when the client didn't send a Content-Length, and is then replayed to the app.
+    '''
+    content_length = Headers(scope=scope).get("Content-Length")
+    if content_length is not None and content_length.isdigit():
+        return int(content_length), receive
+
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] != "http.request":
+            # client went away, let the app see the disconnect
+            replayed: Optional[Message] = message
+            break
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    else:
+        replayed = None
+    body = b"".join(chunks)
+
+    async def replay() -> Message:
+        nonlocal body, replayed
+        if body is not None:
+            message, body = {"type": "http.request", "body": body, "more_body": False}, None
+            return message
+        if replayed is not None:
+            message, replayed = replayed, None
+            return message
+        return await receive()
+
+    return len(body), replay
+
+
+async def _reject(scope: Scope, receive: Receive, send: Send, retry_after: float):
+    error_message = TooManyRequestsError()
+    print(error_message)
+    response = JSONResponse(
+        status_code=error_message.code,
+        content={"code": error_message.code, "message": error_message.message},
+        headers={"Retry-After": str(retry_after_seconds(retry_after))},
+    )
+    await response(scope, receive, send)
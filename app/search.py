@@ -0,0 +1,275 @@
+'''
+Full-text search over conversation names and messages, with two backends:
+  MongoTextSearch, uses the text index on ConversationFull (name, messages.content, archived_text). Mongo keeps
+    the index up to date itself. Messages in the compressed archive tier are matched through archived_text,
+    their snippet is cut out of archived_text on the server, so the archive itself is never read.
+  InMemorySearch, an in-process BM25 inverted index for mongomock/tests, or deployments without a text index.
+    It is built from Mongo on first use and then maintained incrementally as turns are written.
+Neither backend returns whole histories, only a few snippets of the matching messages.
+'''
+import asyncio
+import math
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from archive import load_messages
+from models import ConversationFull, Prompt, SearchHit
+
+# maximum snippets returned per conversation
+MAX_SNIPPETS = 3
+SNIPPET_WIDTH = 160
+# words of archived_text kept on either side of a match
+ARCHIVED_SNIPPET_WORDS = 8
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+def make_snippet(text: str, terms: Iterable[str], width: int = SNIPPET_WIDTH) -> Optional[str]:
+    '''
+    Returns: a window of `width` characters of text around the first matching term, or None if no term matches.
+    '''
+    lowered = text.lower()
+    positions = [pos for pos in (lowered.find(term) for term in terms) if pos >= 0]
+    if not positions:
+        return None
+    start = max(min(positions) - width // 4, 0)
+    end = min(start + width, len(text))
+    return ("..." if start > 0 else "") + text[start:end].strip() + ("..." if end < len(text) else "")
+
+
+def archived_snippet_pattern(terms: List[str], words: int = ARCHIVED_SNIPPET_WORDS) -> str:
+    '''
+    Returns: a regex matching the first word of archived_text containing a term, with up to `words` words
+    around it. archived_text holds single-space separated words, see archive.archive_text.
+    '''
+    pattern = "|".join(re.escape(term) for term in terms)
+    return rf"(?:\w+ ){{0,{words}}}\w*(?:{pattern})\w*(?: \w+){{0,{words}}}"
+
+
+def snippets_for(texts: Iterable[str], terms: List[str]) -> List[str]:
+    snippets = []
+    for text in texts:
+        snippet = make_snippet(text, terms)
+        if snippet is not None:
+            snippets.append(snippet)
+            if len(snippets) == MAX_SNIPPETS:
+                break
+    return snippets
+
+
+class SearchBackend:
+    '''
+    Interface for search backends. The write hooks are no-ops for backends whose index lives in Mongo.
+    '''
+
+    async def search(self, q: str, skip: int, limit: int) -> Tuple[int, List[SearchHit]]:
+        raise NotImplementedError
+
+    async def add_conversation(self, id: UUID, name: str, messages: List[Prompt]):
+        pass
+
+    async def add_turn(self, id: UUID, messages: List[Prompt]):
+        pass
+
+    async def rename(self, id: UUID, name: str):
+        pass
+
+    async def remove(self, id: UUID):
+        pass
+
+
+class MongoTextSearch(SearchBackend):
+    @staticmethod
+    def hit_snippets(doc: dict, terms: List[str]) -> List[str]:
+        snippets = []
+        if doc.get("archived_match"):
+            # archived messages are older than the ones still in messages, so they go first
+            snippets.append("..." + doc["archived_match"]["match"] + "...")
+        return (snippets + snippets_for(doc["matches"], terms))[:MAX_SNIPPETS]
+
+    async def search(self, q: str, skip: int, limit: int) -> Tuple[int, List[SearchHit]]:
+        terms = tokenize(q)
+        if not terms:
+            return 0, []
+        pattern = "|".join(re.escape(term) for term in terms)
+        pipeline = [
+            {"$match": {"$text": {"$search": q}}},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+            {"$sort": {"score": -1}},
+            {
+                "$facet": {
+                    "total": [{"$count": "count"}],
+                    "hits": [
+                        {"$skip": skip},
+                        {"$limit": limit},
+                        {
+                            # only the first few matching messages leave the server, never the whole history
+                            "$project": {
+                                "name": 1,
+                                "score": 1,
+                                "matches": {
+                                    "$slice": [
+                                        {
+                                            "$filter": {
+                                                "input": {"$ifNull": ["$messages.content", []]},
+                                                "cond": {
+                                                    "$regexMatch": {"input": "$$this", "regex": pattern, "options": "i"}
+                                                },
+                                            }
+                                        },
+                                        MAX_SNIPPETS,
+                                    ]
+                                },
+                                # a few words around the first archived match, null if there is none
+                                "archived_match": {
+                                    "$regexFind": {
+                                        "input": {"$ifNull": ["$archived_text", ""]},
+                                        "regex": archived_snippet_pattern(terms),
+                                        "options": "i",
+                                    }
+                                },
+                            }
+                        },
+                    ],
+                }
+            },
+        ]
+        result = (await ConversationFull.aggregate(pipeline).to_list())[0]
+        total = result["total"][0]["count"] if result["total"] else 0
+        hits = [
+            SearchHit(
+                id=doc["_id"],
+                name=doc["name"],
+                score=doc["score"],
+                snippets=self.hit_snippets(doc, terms),
+            )
+            for doc in result["hits"]
+        ]
+        return total, hits
+
+
+class InMemorySearch(SearchBackend):
+    '''
+    BM25 over an in-process inverted index. k1 and b are the usual BM25 parameters.
+    '''
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.loaded = False
+        self._load_lock = asyncio.Lock()
+        # term -> conversation -> term frequency
+        self.postings: Dict[str, Dict[UUID, int]] = defaultdict(dict)
+        self.lengths: Dict[UUID, int] = {}
+        self.names: Dict[UUID, str] = {}
+        # kept for snippets, the name is stored separately so it can be renamed
+        self.texts: Dict[UUID, List[str]] = {}
+        self.total_length = 0
+
+    async def ensure_loaded(self):
+        async with self._load_lock:
+            if self.loaded:
+                return
+            for convo in await ConversationFull.find().to_list():
+                self._index(convo.id, convo.name, load_messages(convo))
+            self.loaded = True
+
+    def _add_terms(self, id: UUID, text: str):
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            postings = self.postings[term]
+            postings[id] = postings.get(id, 0) + count
+        added = sum(counts.values())
+        self.lengths[id] = self.lengths.get(id, 0) + added
+        self.total_length += added
+
+    def _remove_terms(self, id: UUID, text: str):
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            postings = self.postings.get(term)
+            if postings is None or id not in postings:
+                continue
+            postings[id] -= count
+            if postings[id] <= 0:
+                del postings[id]
+            if not postings:
+                del self.postings[term]
+        removed = sum(counts.values())
+        self.lengths[id] -= removed
+        self.total_length -= removed
+
+    def _index(self, id: UUID, name: str, messages: List[Prompt]):
+        self.names[id] = name
+        self.texts[id] = []
+        self._add_terms(id, name)
+        for message in messages:
+            self.texts[id].append(message.content)
+            self._add_terms(id, message.content)
+
+    async def add_conversation(self, id: UUID, name: str, messages: List[Prompt]):
+        if not self.loaded:
+            # will be picked up by the initial load
+            return
+        await self.remove(id)
+        self._index(id, name, messages)
+
+    async def add_turn(self, id: UUID, messages: List[Prompt]):
+        if not self.loaded or id not in self.names:
+            return
+        for message in messages:
+            self.texts[id].append(message.content)
+            self._add_terms(id, message.content)
+
+    async def rename(self, id: UUID, name: str):
+        if not self.loaded or id not in self.names:
+            return
+        self._remove_terms(id, self.names[id])
+        self.names[id] = name
+        self._add_terms(id, name)
+
+    async def remove(self, id: UUID):
+        if id not in self.names:
+            return
+        self._remove_terms(id, self.names.pop(id))
+        for text in self.texts.pop(id):
+            self._remove_terms(id, text)
+        self.lengths.pop(id, None)
+
+    def score(self, terms: List[str]) -> Dict[UUID, float]:
+        count = len(self.names)
+        if count == 0:
+            return {}
+        avg_length = self.total_length / count or 1
+        scores: Dict[UUID, float] = defaultdict(float)
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[id] / avg_length)
+                scores[id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    async def search(self, q: str, skip: int, limit: int) -> Tuple[int, List[SearchHit]]:
+        await self.ensure_loaded()
+        terms = tokenize(q)
+        scores = self.score(terms)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        hits = [
+            SearchHit(id=id, name=self.names[id], score=score, snippets=snippets_for(self.texts[id], terms))
+            for id, score in ranked[skip:skip + limit]
+        ]
+        return len(ranked), hits
+
+
+def create_backend(name: str) -> SearchBackend:
+    if name == "memory":
+        return InMemorySearch()
+    return MongoTextSearch()
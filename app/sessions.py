@@ -0,0 +1,165 @@
+'''
+In-memory chat sessions for the /ws/conversations/{id} WebSocket. A session loads its conversation once,
+keeps the history in memory for as long as it is cached, and only writes new turns back to Mongo.
+'''
+import asyncio
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+from pydantic import BaseModel, Field
+
+from archive import load_messages
+from forks import fork_prefix
+from models import ConversationFull, Prompt
+from writebehind import TurnWriter
+
+# rough per-message overhead of a Prompt on top of its content, used for the memory budget
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+class SessionFreshness(BaseModel):
+    '''
+    Projection used to check a cached session against Mongo without loading the history again.
+    '''
+    id: UUID = Field(..., alias="_id")
+    updated_at: Optional[datetime] = None
+    params: Dict[str, Any] = {}
+    applied_flushes: List[str] = []
+
+
+class ChatSession:
+    def __init__(self, convo: ConversationFull, writer: TurnWriter, prefix: Optional[List[Prompt]] = None):
+        self.id: UUID = convo.id
+        self.params: Dict[str, Any] = convo.params
+        self.tokens: int = convo.tokens or 0
+        # turns still queued by the write-behind writer are part of the history too, and so is the
+        # prefix shared with the parent if this is a fork
+        self.updated_at: Optional[datetime] = writer.pending_updated_at(convo) or convo.updated_at
+        self.history: List[Prompt] = (prefix or []) + load_messages(convo) + writer.pending_messages(convo)
+        self.size = sum(len(m.content) + MESSAGE_OVERHEAD_BYTES for m in self.history)
+        self.connections = 0
+        self.last_used = 0.0
+        # one turn at a time, even if the same conversation is open on several sockets
+        self.lock = asyncio.Lock()
+
+
+class ChatSessionCache:
+    '''
+    LRU cache of ChatSessions.
+      max_sessions and max_bytes, once either is exceeded, least recently used sessions without an open
+        connection are evicted
+      idle_seconds, sessions without an open connection are evicted after this long by sweep()
+      writer, used to persist new turns
+    '''
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+        idle_seconds: float = 300.0,
+        writer: Optional[TurnWriter] = None,
+    ):
+        self.writer = writer or TurnWriter()
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._sessions: "OrderedDict[UUID, ChatSession]" = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    async def acquire(self, id: UUID) -> Optional[ChatSession]:
+        '''
+        Returns the session for a conversation, loading it from Mongo if it isn't cached, or None if the
+        conversation does not exist. Every acquire must be paired with a release.
+        '''
+        session = self._sessions.get(id)
+        if session is not None:
+            session = await self._refresh(session)
+        if session is None:
+            convo = await ConversationFull.get(id)
+            if convo is None:
+                return None
+            prefix = await fork_prefix(convo, self.writer)
+            session = self._add(ChatSession(convo, self.writer, prefix))
+        self._sessions.move_to_end(id)
+        session.connections += 1
+        session.last_used = self._now()
+        self.evict()
+        return session
+
+    def release(self, session: ChatSession):
+        session.connections -= 1
+        session.last_used = self._now()
+        self.evict()
+
+    async def _refresh(self, session: ChatSession) -> Optional[ChatSession]:
+        '''
+        The conversation may have been changed through the HTTP API since it was cached. New turns mean the
+        history has to be reloaded, while new params can just be copied over.
+        '''
+        current = await ConversationFull.find_one({"_id": session.id}).project(SessionFreshness)
+        updated_at = current and (self.writer.pending_updated_at(current) or current.updated_at)
+        if current is None or updated_at != session.updated_at:
+            if session.connections == 0:
+                self._remove(session)
+            return None
+        session.params = current.params
+        return session
+
+    def _add(self, session: ChatSession) -> ChatSession:
+        existing = self._sessions.get(session.id)
+        if existing is not None and existing.updated_at == session.updated_at:
+            # someone else loaded it while we were waiting on Mongo
+            return existing
+        if existing is not None:
+            # stale, sockets still using it keep their reference until they disconnect
+            self._remove(existing)
+        self._sessions[session.id] = session
+        self.size += session.size
+        return session
+
+    def _remove(self, session: ChatSession):
+        if self._sessions.get(session.id) is session:
+            del self._sessions[session.id]
+            self.size -= session.size
+
+    async def record_turn(self, session: ChatSession, user_prompt: Prompt, reply: Prompt, prompt_tokens: int):
+        '''
+        Persists just the new turn, then adds it to the in-memory history.
+        '''
+        session.updated_at = await self.writer.write(session.id, [user_prompt, reply], prompt_tokens)
+        session.history.extend([user_prompt, reply])
+        session.tokens += prompt_tokens
+        added = len(user_prompt.content) + len(reply.content) + 2 * MESSAGE_OVERHEAD_BYTES
+        session.size += added
+        if self._sessions.get(session.id) is session:
+            self.size += added
+        self.evict()
+
+    def evict(self):
+        '''
+        Evicts least recently used sessions without an open connection until we are within budget.
+        '''
+        for session in list(self._sessions.values()):
+            if len(self._sessions) <= self.max_sessions and self.size <= self.max_bytes:
+                return
+            if session.connections == 0:
+                self._remove(session)
+
+    def sweep(self):
+        cutoff = self._now() - self.idle_seconds
+        for session in list(self._sessions.values()):
+            if session.connections == 0 and session.last_used < cutoff:
+                self._remove(session)
+
+    async def run_sweeper(self, interval: float = 30.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
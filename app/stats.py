@@ -0,0 +1,158 @@
+'''
+Usage statistics over the ConversationFull collection, computed entirely by a MongoDB aggregation
+pipeline so that no conversation documents are loaded into Python.
+'''
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import OperationFailure
+
+from models import ConversationFull, DEFAULT_MODEL, StatsResponse
+
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+
+# $percentile needs MongoDB 7.0+, flipped off the first time the server (or mongomock) rejects it
+native_percentiles = True
+# "unknown group operator" and InvalidPipelineOperator
+UNSUPPORTED_OPERATOR_CODES = (15952, 168)
+
+
+def build_match(model: Optional[str] = None, since: Optional[datetime] = None, until: Optional[datetime] = None):
+    match: Dict[str, Any] = {}
+    if model is not None:
+        # conversations without a model param are sent with DEFAULT_MODEL
+        match["params.model"] = {"$in": [model, None]} if model == DEFAULT_MODEL else model
+    if since is not None or until is not None:
+        match["created_at"] = {}
+        if since is not None:
+            match["created_at"]["$gte"] = since
+        if until is not None:
+            match["created_at"]["$lt"] = until
+    return match
+
+
+def _nearest_rank(values: str, p: float):
+    # index = floor((n - 1) * p) into an already sorted array
+    index = {"$toInt": {"$floor": {"$multiply": [{"$subtract": [{"$size": values}, 1]}, p]}}}
+    return {"$arrayElemAt": [values, index]}
+
+
+def _sorted_percentiles(field: str) -> List[Dict[str, Any]]:
+    '''
+    Fallback for servers without $percentile: sort, push just the numbers, and pick by rank.
+    '''
+    return [
+        {"$sort": {field: 1}},
+        {"$group": {"_id": None, "values": {"$push": f"${field}"}}},
+        {"$project": {"_id": 0, **{name: _nearest_rank("$values", p) for name, p in PERCENTILES.items()}}},
+    ]
+
+
+def _breakdown(key: Any, match: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    return [
+        {"$match": match or {}},
+        {
+            "$group": {
+                "_id": key,
+                "conversations": {"$sum": 1},
+                "tokens": {"$sum": "$tokens"},
+                "messages": {"$sum": "$message_count"},
+            }
+        },
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "key": "$_id", "conversations": 1, "tokens": 1, "messages": 1}},
+    ]
+
+
+def build_stats_pipeline(match: Dict[str, Any], native: bool = True) -> List[Dict[str, Any]]:
+    totals_group: Dict[str, Any] = {
+        "_id": None,
+        "conversations": {"$sum": 1},
+        "tokens_total": {"$sum": "$tokens"},
+        "tokens_avg": {"$avg": "$tokens"},
+        "messages_total": {"$sum": "$message_count"},
+        "messages_avg": {"$avg": "$message_count"},
+    }
+    facets: Dict[str, Any] = {
+        "totals": [{"$group": totals_group}],
+        "by_model": _breakdown("$model"),
+        # conversations created before created_at was recorded have no day
+        "by_day": _breakdown(
+            {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            match={"created_at": {"$ne": None}},
+        ),
+    }
+    if native:
+        for field in ("tokens", "message_count"):
+            totals_group[f"{field}_percentiles"] = {
+                "$percentile": {"input": f"${field}", "p": list(PERCENTILES.values()), "method": "approximate"}
+            }
+    else:
+        facets["tokens_percentiles"] = _sorted_percentiles("tokens")
+        facets["message_count_percentiles"] = _sorted_percentiles("message_count")
+
+    return [
+        {"$match": match},
+        {
+            # only the handful of values the stats need survive past this stage
+            "$project": {
+                "_id": 0,
+                "tokens": {"$ifNull": ["$tokens", 0]},
+                # forks count the messages they share with their parent too
+                "message_count": {
+                    "$add": [
+                        {"$size": {"$ifNull": ["$messages", []]}},
+                        {"$ifNull": ["$archived_count", 0]},
+                        {"$ifNull": ["$fork_point", 0]},
+                    ]
+                },
+                "model": {"$ifNull": ["$params.model", DEFAULT_MODEL]},
+                "created_at": 1,
+            }
+        },
+        {"$facet": facets},
+    ]
+
+
+def _distribution(totals: Dict[str, Any], percentiles: Any, prefix: str) -> Dict[str, Any]:
+    if isinstance(percentiles, list):
+        # native $percentile returns values in the same order as PERCENTILES
+        percentiles = dict(zip(PERCENTILES, percentiles))
+    return {
+        "total": totals.get(f"{prefix}_total", 0),
+        "avg": totals.get(f"{prefix}_avg"),
+        **(percentiles or {}),
+    }
+
+
+def parse_stats(result: Dict[str, Any]) -> StatsResponse:
+    totals = result["totals"][0] if result["totals"] else {}
+    if "tokens_percentiles" in totals:
+        tokens_percentiles = totals["tokens_percentiles"]
+        message_percentiles = totals["message_count_percentiles"]
+    else:
+        tokens_percentiles = (result.get("tokens_percentiles") or [None])[0]
+        message_percentiles = (result.get("message_count_percentiles") or [None])[0]
+    return StatsResponse(
+        conversations=totals.get("conversations", 0),
+        tokens=_distribution(totals, tokens_percentiles, "tokens"),
+        messages=_distribution(totals, message_percentiles, "messages"),
+        by_model=result["by_model"],
+        by_day=result["by_day"],
+    )
+
+
+async def conversation_stats(match: Dict[str, Any]) -> StatsResponse:
+    global native_percentiles
+    if native_percentiles:
+        try:
+            result = await ConversationFull.aggregate(build_stats_pipeline(match, native=True)).to_list()
+            return parse_stats(result[0])
+        except OperationFailure as e:
+            if e.code not in UNSUPPORTED_OPERATOR_CODES:
+                raise
+            native_percentiles = False
+        except NotImplementedError:
+            native_percentiles = False
+    result = await ConversationFull.aggregate(build_stats_pipeline(match, native=False)).to_list()
+    return parse_stats(result[0])
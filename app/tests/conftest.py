@@ -2,11 +2,27 @@ import sys
 from pathlib import Path
 import os
 import pytest
+import pytest_asyncio
+from beanie import init_beanie
+from mongomock_motor import AsyncMongoMockClient
 
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
+from models import ArchiveMetrics, ConversationFull, IdempotencyRecord
+
 @pytest.fixture(autouse=True)
 def setup_test_env():
     os.environ["TEST_ENV"] = "True"
     yield
     del os.environ["TEST_ENV"]
+
+
+@pytest_asyncio.fixture
+async def mongo_db():
+    """
+    Fresh in-memory database with every document model initialised, for tests that need Beanie.
+    """
+    mock_client = AsyncMongoMockClient("mongodb://localhost:27017")
+    db = mock_client["govtech_backend"]
+    await init_beanie(document_models=[ConversationFull, IdempotencyRecord, ArchiveMetrics], database=db)
+    yield db
@@ -0,0 +1,108 @@
+from unittest.mock import patch, AsyncMock
+from datetime import datetime, timedelta
+import pytest
+from httpx import AsyncClient
+from main import app
+from models import ConversationFull, ArchiveMetrics, Prompt
+from archive import ArchiveCompactor, backfill_message_counts, load_messages, pack_messages, unpack_messages
+
+
+def make_messages(count):
+    return [Prompt(role="user", content=f"message {i}") for i in range(count)]
+
+
+def test_pack_round_trip():
+    messages = make_messages(5)
+    assert unpack_messages(pack_messages(messages)) == messages
+    assert unpack_messages(None) == []
+
+
+@pytest.mark.asyncio
+async def test_compaction_keeps_recent_messages(mongo_db):
+    convo = ConversationFull(name="Active", params={}, messages=make_messages(30), updated_at=datetime.utcnow())
+    await convo.insert()
+
+    compactor = ArchiveCompactor(keep_recent=10, min_fold=5, rate=1000)
+    assert await compactor.run_batch() == 1
+
+    stored = await ConversationFull.get(convo.id)
+    assert len(stored.messages) == 10
+    assert stored.message_count == 10
+    assert stored.archived_count == 20
+    assert load_messages(stored) == make_messages(30)
+    # the archived words stay in the text index
+    assert stored.archived_text.split() == ["message"] + [str(i) for i in range(20)]
+
+    metrics = await ArchiveMetrics.get("compaction")
+    assert metrics.messages == 20
+    assert metrics.reclaimed_bytes == metrics.bytes_before - metrics.bytes_after
+
+
+@pytest.mark.asyncio
+async def test_compaction_folds_idle_conversations(mongo_db):
+    convo = ConversationFull(
+        name="Idle", params={}, messages=make_messages(3), updated_at=datetime.utcnow() - timedelta(days=30)
+    )
+    await convo.insert()
+
+    compactor = ArchiveCompactor(keep_recent=10, min_fold=5, idle_seconds=3600, rate=1000)
+    assert await compactor.run_batch() == 1
+
+    stored = await ConversationFull.get(convo.id)
+    assert stored.messages == []
+    assert load_messages(stored) == make_messages(3)
+
+
+@pytest.mark.asyncio
+async def test_legacy_conversations_are_backfilled(mongo_db):
+    convo = ConversationFull(name="Legacy", params={}, messages=make_messages(30), updated_at=datetime.utcnow())
+    await convo.insert()
+    await ConversationFull.find_one({"_id": convo.id}).update({"$unset": {"message_count": ""}})
+
+    compactor = ArchiveCompactor(keep_recent=10, min_fold=5, rate=1000)
+    # without message_count the indexed candidates query doesn't see it
+    assert await compactor.run_batch() == 0
+    assert await backfill_message_counts() == 1
+    assert await compactor.run_batch() == 1
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_returns_archived_messages(mongo_db):
+    convo = ConversationFull(
+        name="Archived",
+        params={},
+        messages=make_messages(4)[2:],
+        archived_messages=pack_messages(make_messages(4)[:2]),
+        archived_count=2,
+    )
+    await convo.insert()
+
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.get(f"/conversations/{convo.id}")
+        assert response.status_code == 200
+        data = response.json()
+        assert [m["content"] for m in data["messages"]] == [f"message {i}" for i in range(4)]
+        assert "archived_messages" not in data
+
+
+@pytest.mark.asyncio
+async def test_query_sends_archived_history(mongo_db):
+    convo = ConversationFull(
+        name="Archived",
+        params={},
+        messages=make_messages(2)[1:],
+        archived_messages=pack_messages(make_messages(1)),
+        archived_count=1,
+    )
+    await convo.insert()
+
+    reply = Prompt(role="assistant", content="reply")
+    with patch("main.get_chatgpt_response", new_callable=AsyncMock, return_value=reply) as mock_chat:
+        async with AsyncClient(app=app, base_url="http://test") as ac:
+            response = await ac.post(f"/queries/{convo.id}", json={"role": "user", "content": "next"})
+        assert response.status_code == 201
+        assert mock_chat.await_args.kwargs["conversation_history"] == make_messages(2)
+
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == ["message 1", "next", "reply"]
+    assert stored.archived_count == 1
@@ -0,0 +1,28 @@
+import pytest
+from models import ConversationFull
+from benchmarks.bench import compare, selected, synthetic_conversation
+
+
+@pytest.mark.asyncio
+async def test_synthetic_conversation_is_valid(mongo_db):
+    raw = synthetic_conversation(10)
+    assert len(raw["messages"]) == 10
+    assert [m["role"] for m in raw["messages"][:2]] == ["user", "assistant"]
+    ConversationFull.model_validate(raw)
+
+
+def test_compare_flags_regressions_beyond_threshold():
+    baseline = {"validate[10]": 1.0, "model_dump[10]": 1.0, "removed[10]": 1.0}
+    results = {"validate[10]": 1.2, "model_dump[10]": 1.5, "new[10]": 9.0}
+    regressions = compare(results, baseline, threshold=0.25)
+    # a benchmark that stopped running is a failure too, a new one is not
+    assert len(regressions) == 2
+    assert regressions[0] == "removed[10]: not run"
+    assert regressions[1].startswith("model_dump[10]")
+
+
+def test_selected_respects_sizes_and_prefixes():
+    assert selected("validate[10]", sizes=[10])
+    assert not selected("validate[1000]", sizes=[10])
+    assert selected("http_exception_handler", sizes=[10])
+    assert not selected("http_exception_handler", sizes=[10], only=["encode"])
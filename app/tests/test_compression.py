@@ -0,0 +1,46 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+from main import app
+from compression import CompressionMiddleware, select_encoding, parse_accept_encoding
+
+client = TestClient(app)
+
+# Small standalone app so the middleware can be exercised without a database.
+big_app = FastAPI()
+big_app.add_middleware(CompressionMiddleware, minimum_size=500)
+
+
+@big_app.get("/big")
+async def big():
+    return [{"role": "user", "content": "hello there " * 20} for _ in range(20)]
+
+
+big_client = TestClient(big_app)
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("gzip;q=0.5, br") == {"gzip": 0.5, "br": 1.0}
+
+
+def test_select_encoding_respects_q_values():
+    assert select_encoding("gzip;q=0.5, br", available=["br", "gzip"]) == "br"
+    assert select_encoding("gzip, br;q=0", available=["br", "gzip"]) == "gzip"
+    assert select_encoding("identity", available=["gzip"]) is None
+    assert select_encoding("*", available=["gzip"]) == "gzip"
+
+
+def test_small_responses_are_not_compressed():
+    response = client.get("/health", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+def test_large_responses_are_gzipped():
+    with patch("compression.select_encoding", return_value="gzip"):
+        response = big_client.get("/big", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) < len(response.content)
+        assert len(response.json()) == 20
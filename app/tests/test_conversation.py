@@ -146,4 +146,21 @@ async def test_update_conversation_not_found():
     with patch('models.ConversationFull.get', return_value=None):
         async with AsyncClient(app=app, base_url="http://test") as ac:
             response = await ac.put(f"/conversations/{test_uuid}", json=convo_update.dict())
-            assert response.status_code == 404
\ No newline at end of file
+            assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_get_all_conversations_unknown_field():
+    response = client.get("/conversations?fields=name,secret")
+    assert response.status_code == 400
+    assert response.json()['code'] == 400
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_fields_not_found():
+    test_uuid = uuid4()
+    query = MagicMock()
+    query.project = AsyncMock(return_value=None)
+    with patch.object(ConversationFull, 'find_one', return_value=query):
+        response = client.get(f"/conversations/{test_uuid}?fields=name")
+        assert response.status_code == 404
+        assert response.json()['code'] == 404
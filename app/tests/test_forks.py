@@ -0,0 +1,142 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch, AsyncMock
+import pytest
+from main import app
+from models import ConversationFull, Prompt
+from archive import ArchiveCompactor, load_messages
+from forks import detach_forks, fork_conversation, fork_prefix
+from writebehind import TurnWriter
+
+client = TestClient(app)
+
+
+def make_messages(start, count):
+    return [Prompt(role="user", content=f"message {i}") for i in range(start, start + count)]
+
+
+@pytest.mark.asyncio
+async def test_fork_chain_shares_prefix(mongo_db):
+    writer = TurnWriter()
+    root = ConversationFull(name="Root", params={}, messages=make_messages(0, 6))
+    await root.insert()
+
+    child = await fork_conversation(root, 4, writer)
+    assert child.messages == []
+    await writer.write(child.id, make_messages(100, 2), 0)
+    child = await ConversationFull.get(child.id)
+
+    grandchild = await fork_conversation(child, 5, writer)
+    assert [m.content for m in await fork_prefix(grandchild, writer)] == [
+        "message 0", "message 1", "message 2", "message 3", "message 100"
+    ]
+
+    # forking at 0 shares nothing, so the parent is never read
+    with patch.object(ConversationFull, "get", new_callable=AsyncMock) as get:
+        assert await fork_prefix(await fork_conversation(child, 0, writer), writer) == []
+        get.assert_not_called()
+
+    with pytest.raises(ValueError):
+        await fork_conversation(root, 7, writer)
+
+
+@pytest.mark.asyncio
+async def test_fork_route_and_reads(mongo_db):
+    parent = ConversationFull(name="Parent", params={"temperature": 0.5}, messages=make_messages(0, 4))
+    await parent.insert()
+
+    response = client.post(f"/conversations/{parent.id}/fork", params={"at": 2})
+    assert response.status_code == 201
+    fork_id = response.json()["id"]
+
+    # only the fork's own turns are stored on it
+    stored = await ConversationFull.get(fork_id)
+    assert stored.messages == [] and stored.parent_id == parent.id and stored.fork_point == 2
+
+    body = client.get(f"/conversations/{fork_id}").json()
+    assert [m["content"] for m in body["messages"]] == ["message 0", "message 1"]
+    assert body["params"] == {"temperature": 0.5}
+    body = client.get(f"/conversations/{fork_id}", params={"fields": "messages"}).json()
+    assert [m["content"] for m in body["messages"]] == ["message 0", "message 1"]
+    # parent_id and fork_point are read to rebuild messages, but only returned when asked for
+    assert set(body) == {"_id", "messages"}
+    body = client.get("/conversations", params={"fields": "messages,fork_point"}).json()
+    assert all(set(c) == {"_id", "messages", "fork_point"} for c in body)
+
+    assert client.post(f"/conversations/{parent.id}/fork", params={"at": 5}).status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_query_on_fork_sends_shared_history(mongo_db):
+    parent = ConversationFull(name="Parent", params={}, messages=make_messages(0, 4))
+    await parent.insert()
+    fork_id = client.post(f"/conversations/{parent.id}/fork", params={"at": 3}).json()["id"]
+
+    reply = Prompt(role="assistant", content="reply")
+    with patch("main.get_chatgpt_response", new_callable=AsyncMock, return_value=reply) as get_response:
+        response = client.post(f"/queries/{fork_id}", json={"role": "user", "content": "follow up"})
+    assert response.status_code == 201
+    history = get_response.call_args.kwargs["conversation_history"]
+    assert [m.content for m in history] == ["message 0", "message 1", "message 2"]
+
+    stored = await ConversationFull.get(fork_id)
+    assert [m.content for m in stored.messages] == ["follow up", "reply"]
+
+
+@pytest.mark.asyncio
+async def test_deleting_parent_detaches_forks(mongo_db):
+    parent = ConversationFull(name="Parent", params={}, messages=make_messages(0, 4))
+    await parent.insert()
+    fork = await fork_conversation(parent, 3, TurnWriter())
+    await TurnWriter().write(fork.id, make_messages(100, 30), 0)
+    # the fork's own turns were already compacted, the prefix has to go in front of them
+    await ArchiveCompactor(keep_recent=10, min_fold=5, rate=1000).run_batch()
+
+    assert client.delete(f"/conversations/{parent.id}").status_code == 204
+    assert await ConversationFull.get(parent.id) is None
+
+    stored = await ConversationFull.get(fork.id)
+    assert stored.parent_id is None and stored.fork_point == 0
+    assert load_messages(stored) == make_messages(0, 3) + make_messages(100, 30)
+
+
+@pytest.mark.asyncio
+async def test_missing_parent_fails_the_read(mongo_db):
+    parent = ConversationFull(name="Parent", params={}, messages=make_messages(0, 4))
+    await parent.insert()
+    fork = await fork_conversation(parent, 2, TurnWriter())
+    await ConversationFull.find_one({"_id": parent.id}).delete()
+
+    with pytest.raises(RuntimeError):
+        await fork_prefix(fork, TurnWriter())
+    assert client.get(f"/conversations/{fork.id}").status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_forks_created_while_deleting_are_detached(mongo_db):
+    parent = ConversationFull(name="Parent", params={}, messages=make_messages(0, 4))
+    await parent.insert()
+    late = []
+
+    async def fork_after_listing(convo, writer):
+        detached = await detach_forks(convo, writer)
+        if not late:
+            # a concurrent POST /fork that got in between listing the forks and the delete
+            late.append(await fork_conversation(convo, 2, writer))
+        return detached
+
+    with patch("main.detach_forks", side_effect=fork_after_listing):
+        assert client.delete(f"/conversations/{parent.id}").status_code == 204
+    stored = await ConversationFull.get(late[0].id)
+    assert stored.parent_id is None
+    assert load_messages(stored) == make_messages(0, 2)
+
+
+@pytest.mark.asyncio
+async def test_fork_of_deleted_parent_is_removed(mongo_db):
+    parent = ConversationFull(name="Parent", params={}, messages=make_messages(0, 4))
+    await parent.insert()
+    await parent.delete()
+
+    with pytest.raises(LookupError):
+        await fork_conversation(parent, 2, TurnWriter())
+    assert await ConversationFull.find({"parent_id": parent.id}).count() == 0
@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from hedging import HedgeBudget, Hedger
+
+
+def warmed_up_hedger(**kwargs):
+    hedger = Hedger(enabled=True, min_samples=5, min_delay=0.01, **kwargs)
+    hedger.latencies.extend([0.01] * 10)
+    return hedger
+
+
+@pytest.mark.asyncio
+async def test_slow_primary_is_hedged_and_cancelled():
+    hedger = warmed_up_hedger(max_ratio=1.0)
+    calls = []
+    cancelled = []
+
+    async def attempt():
+        calls.append(1)
+        try:
+            # first call is pathologically slow, the hedge answers quickly
+            await asyncio.sleep(5 if len(calls) == 1 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return len(calls)
+
+    assert await hedger.run(attempt) == 2
+    await asyncio.sleep(0)
+    assert len(calls) == 2
+    assert cancelled == [1]
+    assert hedger.hedges_won == 1
+
+
+@pytest.mark.asyncio
+async def test_hedge_ratio_is_capped():
+    hedger = warmed_up_hedger(max_ratio=0.0)
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    assert await hedger.run(attempt) == "ok"
+    assert len(calls) == 1
+    assert hedger.hedged_count == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_attempt_waits_for_the_other():
+    hedger = warmed_up_hedger(max_ratio=1.0)
+    calls = []
+
+    async def attempt():
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("upstream error")
+        await asyncio.sleep(0.05)
+        return "primary"
+
+    assert await hedger.run(attempt) == "primary"
+
+
+@pytest.mark.asyncio
+async def test_hedgers_keep_their_own_latencies_but_share_the_budget():
+    budget = HedgeBudget(max_ratio=0.5)
+    for _ in range(2):
+        budget.record(hedged=False)
+    completions = warmed_up_hedger(budget=budget)
+    streams = Hedger(enabled=True, min_samples=5, min_delay=0.01, budget=budget)
+    streams.latencies.extend([1.0] * 10)
+    assert completions.delay() == 0.01
+    assert streams.delay() == 1.0
+
+    async def attempt():
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    # one request each, the stream isn't hedged at all since it's faster than its own window
+    assert await completions.run(attempt) == "ok"
+    assert await streams.run(attempt) == "ok"
+    assert budget.hedged_count == 1
+    assert completions.hedged_count == streams.hedged_count == 1
+    assert len(budget.hedged) == 4
+
+
+@pytest.mark.asyncio
+async def test_disabled_hedger_makes_one_attempt():
+    hedger = Hedger(enabled=False)
+
+    async def attempt():
+        raise RuntimeError("upstream error")
+
+    with pytest.raises(RuntimeError):
+        await hedger.run(attempt)
+    assert hedger.delay() is None
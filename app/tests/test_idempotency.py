@@ -0,0 +1,89 @@
+from fastapi import HTTPException
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from models import IdempotencyRecord
+from idempotency import IdempotencyStore
+
+
+@pytest.mark.asyncio
+async def test_concurrent_duplicates_share_one_call(mongo_db):
+    store = IdempotencyStore(wait_timeout=5)
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"id": "abc"}
+
+    results = await asyncio.gather(*(store.run("convo", "key", "fp", handler) for _ in range(3)))
+    assert results == [{"id": "abc"}] * 3
+    # a later retry is served from Mongo as well
+    assert await store.run("convo", "key", "fp", handler) == {"id": "abc"}
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_reused_key_with_different_body(mongo_db):
+    store = IdempotencyStore()
+
+    async def handler():
+        return {"id": "abc"}
+
+    await store.run("convo", "key", "fp", handler)
+    with pytest.raises(HTTPException) as exc_info:
+        await store.run("convo", "key", "other-fp", handler)
+    assert exc_info.value.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_failed_request_frees_the_key(mongo_db):
+    store = IdempotencyStore()
+
+    async def failing_handler():
+        raise HTTPException(status_code=422, detail="OpenAI API error")
+
+    async def handler():
+        return {"id": "abc"}
+
+    with pytest.raises(HTTPException):
+        await store.run("convo", "key", "fp", failing_handler)
+    assert await store.run("convo", "key", "fp", handler) == {"id": "abc"}
+
+
+@pytest.mark.asyncio
+async def test_long_running_original_keeps_its_lease(mongo_db):
+    # two stores stand in for two workers, so the duplicate can only see the original through Mongo
+    original_worker = IdempotencyStore(lease_seconds=0.15)
+    other_worker = IdempotencyStore(wait_timeout=5, poll_interval=0.02, lease_seconds=0.15)
+    calls = []
+
+    async def handler():
+        calls.append(1)
+        # runs for several lease lengths, renewals must stop it from being taken over
+        await asyncio.sleep(0.5)
+        return {"id": "abc"}
+
+    first = asyncio.create_task(original_worker.run("convo", "key", "fp", handler))
+    await asyncio.sleep(0.05)
+    assert await other_worker.run("convo", "key", "fp", handler) == {"id": "abc"}
+    assert await first == {"id": "abc"}
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_expired_claim_is_taken_over_and_old_owner_cannot_overwrite(mongo_db):
+    store = IdempotencyStore(lease_seconds=5)
+    dead = IdempotencyRecord(
+        id="convo:key", fingerprint="fp", owner="dead-worker", lease_expires=datetime.utcnow() - timedelta(seconds=1)
+    )
+    await dead.insert()
+
+    async def handler():
+        return {"id": "new"}
+
+    assert await store.run("convo", "key", "fp", handler) == {"id": "new"}
+    # the dead worker waking up and finishing must not touch the new owner's record
+    await store._owned(dead).delete()
+    record = await IdempotencyRecord.get("convo:key")
+    assert record is not None and record.response == {"id": "new"}
@@ -0,0 +1,70 @@
+import asyncio
+import os
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+from uuid import uuid4
+from main import app
+from profiling import Profiler, ProfilingMiddleware
+
+client = TestClient(app)
+
+
+def make_client(profiler):
+    profiled_app = FastAPI()
+    profiled_app.add_middleware(ProfilingMiddleware, profiler=profiler)
+
+    @profiled_app.get("/slow")
+    async def slow_endpoint():
+        await asyncio.sleep(0.05)
+        return {"total": sum(i * i for i in range(200000))}
+
+    return TestClient(profiled_app)
+
+
+def test_profile_is_written_as_collapsed_stacks(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), token="secret", interval=0.001)
+    response = make_client(profiler).get("/slow", headers={"X-Profile": "secret"})
+    assert response.status_code == 200
+
+    profile_id = response.headers["X-Profile-Id"]
+    lines = (tmp_path / f"{profile_id.replace('-', '')}.folded").read_text().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+    # both the await and the CPU work of the endpoint are attributed to it
+    assert any("slow_endpoint" in line and "[waiting]" in line for line in lines)
+    assert any("slow_endpoint" in line and "[waiting]" not in line for line in lines)
+
+
+def test_only_the_newest_profiles_are_kept(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), max_files=3)
+    ids = [uuid4() for _ in range(3)]
+    for age, profile_id in zip((30, 20, 10), ids):
+        profiler.write(profile_id, "main;handler 1\n")
+        os.utime(profiler.path(profile_id), (0, 1000 - age))
+    profiler.max_files = 2
+    assert profiler.prune() == 1
+    assert profiler.read(ids[0]) is None
+    assert profiler.read(ids[1]) is not None and profiler.read(ids[2]) is not None
+
+
+def test_requests_are_not_profiled_without_token(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), token="secret")
+    profiled_client = make_client(profiler)
+    assert "X-Profile-Id" not in profiled_client.get("/slow", headers={"X-Profile": "wrong"}).headers
+    assert "X-Profile-Id" not in profiled_client.get("/slow").headers
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_debug_endpoint_requires_token(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path), token="secret")
+    profile_id = "0" * 32
+    (tmp_path / f"{profile_id}.folded").write_text("main;handler 3\n")
+    with patch("main.profiling_enabled", True), patch("main.profiler", profiler):
+        response = client.get(f"/debug/profiles/{profile_id}", headers={"X-Profile": "secret"})
+        assert response.status_code == 200
+        assert response.text == "main;handler 3\n"
+        assert client.get(f"/debug/profiles/{profile_id}").status_code == 404
+    assert client.get(f"/debug/profiles/{profile_id}", headers={"X-Profile": "secret"}).status_code == 404
@@ -0,0 +1,110 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from ratelimit import RateLimiter, RateLimitMiddleware, client_key, hash_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+clock = FakeClock()
+crud = RateLimiter(rate=1, capacity=2, clock=clock)
+queries = RateLimiter(rate=10, capacity=100, clock=clock)
+limited_app = FastAPI()
+api_keys = frozenset(hash_key(key) for key in ("crud-client", "other", "query-client"))
+limited_app.add_middleware(RateLimitMiddleware, crud=crud, queries=queries, api_keys=api_keys)
+
+
+@limited_app.get("/conversations")
+async def conversations():
+    return []
+
+
+@limited_app.post("/queries/{id}")
+async def query(id: str, body: dict):
+    return {"id": id, "content": body["content"]}
+
+
+limited_client = TestClient(limited_app)
+
+
+def test_bucket_refills_and_reports_retry_after():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=2, capacity=4, clock=clock)
+    assert all(limiter.take("a") == 0 for _ in range(4))
+    assert limiter.take("a") == 0.5
+    # other clients have their own bucket
+    assert limiter.take("b") == 0
+    clock.now = 1.0
+    assert limiter.take("a") == 0 and limiter.take("a") == 0
+    assert limiter.take("a") > 0
+    # requests larger than the bucket are charged a full bucket rather than rejected forever
+    clock.now = 10.0
+    assert limiter.take("a", cost=50) == 0
+
+
+def test_sweep_evicts_idle_buckets():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, capacity=10, idle_seconds=5, clock=clock)
+    limiter.take("old")
+    clock.now = 8.0
+    limiter.take("recent")
+    # idle_seconds is raised to the 10s an empty bucket needs to refill
+    assert limiter.sweep() == 0
+    clock.now = 12.0
+    assert limiter.sweep() == 1
+    assert len(limiter) == 1
+
+
+def test_max_clients_evicts_least_recently_used():
+    limiter = RateLimiter(rate=1, capacity=10, max_clients=2, clock=FakeClock())
+    limiter.take("a")
+    limiter.take("b")
+    limiter.take("a")
+    limiter.take("c")
+    assert len(limiter) == 2
+    assert list(limiter._buckets) == ["a", "c"]
+
+
+def test_only_configured_api_keys_get_their_own_bucket():
+    def scope(headers):
+        return {"type": "http", "headers": headers, "client": ("10.0.0.1", 1234)}
+
+    assert client_key(scope([(b"x-api-key", b"known")]), api_keys) == "ip:10.0.0.1"
+    keys = frozenset([hash_key("known")])
+    assert client_key(scope([(b"x-api-key", b"known")]), keys) == "key:" + hash_key("known")
+    assert client_key(scope([(b"authorization", b"Bearer known")]), keys) == "key:" + hash_key("known")
+    # made-up keys fall back to the IP, so they can't be used to get fresh buckets
+    assert client_key(scope([(b"x-api-key", b"made-up")]), keys) == "ip:10.0.0.1"
+
+
+def test_middleware_rejects_with_retry_after():
+    clock.now = 100.0
+    headers = {"X-API-Key": "crud-client"}
+    assert limited_client.get("/conversations", headers=headers).status_code == 200
+    assert limited_client.get("/conversations", headers=headers).status_code == 200
+    response = limited_client.get("/conversations", headers=headers)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert response.json() == {"code": 429, "message": "Too many requests, retry later"}
+    # a different key is unaffected
+    assert limited_client.get("/conversations", headers={"X-API-Key": "other"}).status_code == 200
+
+
+def test_queries_are_weighted_by_prompt_size():
+    clock.now = 200.0
+    headers = {"X-API-Key": "query-client"}
+    small = {"role": "user", "content": "hi"}
+    large = {"role": "user", "content": "x" * 300}
+    assert limited_client.post("/queries/1", json=large, headers=headers).status_code == 200
+    # the large prompt used most of the bucket, the small one still fits
+    assert limited_client.post("/queries/1", json=large, headers=headers).status_code == 429
+    response = limited_client.post("/queries/1", json=small, headers=headers)
+    assert response.status_code == 200
+    assert response.json() == {"id": "1", "content": "hi"}
+    # the CRUD bucket is separate
+    assert limited_client.get("/conversations", headers=headers).status_code == 200
@@ -0,0 +1,88 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+import pytest
+from main import app
+from models import ConversationFull, Prompt
+import re
+from archive import archive_text
+from search import InMemorySearch, MongoTextSearch, archived_snippet_pattern, make_snippet
+
+client = TestClient(app)
+
+
+async def insert(name, *contents):
+    convo = ConversationFull(
+        name=name, params={}, messages=[Prompt(role="user", content=content) for content in contents]
+    )
+    await convo.insert()
+    return convo
+
+
+def test_make_snippet():
+    text = "a" * 200 + " the mongo text index " + "b" * 200
+    snippet = make_snippet(text, ["mongo"], width=40)
+    assert "mongo" in snippet
+    assert snippet.startswith("...") and snippet.endswith("...")
+    assert make_snippet("nothing here", ["mongo"]) is None
+
+
+def test_archived_snippets_come_from_archived_text():
+    text = archive_text([Prompt(role="user", content=" ".join(f"w{i}" for i in range(40)) + " Mongo indexes")])
+    match = re.search(archived_snippet_pattern(["mongo"], words=3), text, re.IGNORECASE).group(0)
+    assert match == "w37 w38 w39 mongo indexes"
+    assert re.search(archived_snippet_pattern(["absent"]), text) is None
+
+    doc = {"archived_match": {"match": match}, "matches": ["mongo one", "mongo two", "mongo three"]}
+    assert MongoTextSearch.hit_snippets(doc, ["mongo"]) == ["..." + match + "...", "mongo one", "mongo two"]
+    assert MongoTextSearch.hit_snippets({"archived_match": None, "matches": ["mongo"]}, ["mongo"]) == ["mongo"]
+
+
+@pytest.mark.asyncio
+async def test_bm25_ranking_and_incremental_turns(mongo_db):
+    often = await insert("Databases", "mongo indexes", "mongo text search", "mongo aggregation")
+    once = await insert("Misc", "a long conversation about many things, mongo being one of them")
+    await insert("Cooking", "pasta recipes")
+
+    index = InMemorySearch()
+    total, hits = await index.search("mongo", skip=0, limit=10)
+    assert total == 2
+    assert [hit.id for hit in hits] == [often.id, once.id]
+    assert all("mongo" in s for s in hits[0].snippets)
+
+    # turns written after the initial load are indexed without reloading
+    await index.add_turn(once.id, [Prompt(role="user", content="tiramisu")])
+    total, hits = await index.search("tiramisu", skip=0, limit=10)
+    assert [hit.id for hit in hits] == [once.id]
+
+    await index.rename(often.id, "Renamed")
+    total, hits = await index.search("databases", skip=0, limit=10)
+    assert total == 0
+
+    await index.remove(once.id)
+    total, hits = await index.search("mongo", skip=0, limit=10)
+    assert [hit.id for hit in hits] == [often.id]
+
+
+@pytest.mark.asyncio
+async def test_search_route_paginates(mongo_db):
+    for i in range(3):
+        await insert(f"Conversation {i}", f"kubernetes question {i}")
+
+    with patch("main.search_backend", InMemorySearch()):
+        response = client.get("/search", params={"q": "kubernetes", "page": 2, "page_size": 2})
+        assert response.status_code == 200
+        body = response.json()
+        assert body["total"] == 3
+        assert body["page"] == 2
+        assert len(body["results"]) == 1
+        assert "messages" not in body["results"][0]
+
+        created = client.post("/conversations", json={"name": "kubernetes notes", "params": {}})
+        assert created.status_code == 201
+        body = client.get("/search", params={"q": "notes"}).json()
+        assert [hit["id"] for hit in body["results"]] == [created.json()["id"]]
+
+
+def test_search_requires_query():
+    response = client.get("/search")
+    assert response.status_code == 400
@@ -0,0 +1,58 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+from datetime import datetime
+import pytest
+from httpx import AsyncClient
+from main import app
+from models import ConversationFull, Prompt, DEFAULT_MODEL
+
+client = TestClient(app)
+
+
+async def insert_conversations():
+    for i in range(4):
+        await ConversationFull(
+            name=f"Conversation {i}",
+            params={"model": "gpt-4"} if i == 0 else {},
+            tokens=i * 10,
+            messages=[Prompt(role="user", content="hi")] * i,
+            created_at=datetime(2024, 1, 1 + i % 2),
+        ).insert()
+
+
+@pytest.mark.asyncio
+async def test_get_stats(mongo_db):
+    await insert_conversations()
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.get("/stats")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["conversations"] == 4
+    assert data["tokens"]["total"] == 60
+    assert data["messages"]["total"] == 6
+    assert data["messages"]["p50"] == 1
+    assert {row["key"]: row["conversations"] for row in data["by_model"]} == {DEFAULT_MODEL: 3, "gpt-4": 1}
+    assert [row["key"] for row in data["by_day"]] == ["2024-01-01", "2024-01-02"]
+
+
+@pytest.mark.asyncio
+async def test_get_stats_filtered_by_model(mongo_db):
+    await insert_conversations()
+    async with AsyncClient(app=app, base_url="http://test") as ac:
+        response = await ac.get("/stats", params={"model": "gpt-4"})
+    assert response.status_code == 200
+    assert response.json()["conversations"] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_stats_invalid_params():
+    response = client.get("/stats?since=yesterday")
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_stats_internal_server_error():
+    with patch.object(ConversationFull, 'aggregate', side_effect=Exception("Database error")):
+        response = client.get("/stats")
+        assert response.status_code == 500
+        assert response.json()['code'] == 500
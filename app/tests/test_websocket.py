@@ -0,0 +1,96 @@
+from fastapi.testclient import TestClient
+from unittest.mock import patch
+from uuid import uuid4
+import pytest
+from main import app
+from models import ConversationFull, Prompt
+from ratelimit import RateLimiter
+from sessions import ChatSessionCache
+
+client = TestClient(app)
+
+
+async def fake_stream(conversation_history, query_message, params):
+    for chunk in ["Hello", " there"]:
+        yield chunk
+
+
+@pytest.mark.asyncio
+async def test_websocket_streams_and_persists_turn(mongo_db):
+    convo = ConversationFull(name="Chat", params={}, messages=[Prompt(role="user", content="earlier")])
+    await convo.insert()
+
+    with patch("main.stream_chatgpt_response", side_effect=fake_stream):
+        with client.websocket_connect(f"/ws/conversations/{convo.id}") as ws:
+            ws.send_json({"role": "user", "content": "hi"})
+            assert ws.receive_json() == {"type": "token", "content": "Hello"}
+            assert ws.receive_json() == {"type": "token", "content": " there"}
+            done = ws.receive_json()
+            assert done["type"] == "done"
+            assert done["message"] == {"role": "assistant", "content": "Hello there"}
+
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == ["earlier", "hi", "Hello there"]
+
+
+@pytest.mark.asyncio
+async def test_websocket_invalid_prompt(mongo_db):
+    convo = ConversationFull(name="Chat", params={}, messages=[])
+    await convo.insert()
+
+    with client.websocket_connect(f"/ws/conversations/{convo.id}") as ws:
+        ws.send_json({"role": "robot", "content": "hi"})
+        error = ws.receive_json()
+        assert error["type"] == "error"
+        assert error["code"] == 400
+
+
+@pytest.mark.asyncio
+async def test_websocket_prompts_are_rate_limited(mongo_db):
+    convo = ConversationFull(name="Chat", params={}, messages=[])
+    await convo.insert()
+    limiter = RateLimiter(rate=1, capacity=20)
+
+    with patch("main.stream_chatgpt_response", side_effect=fake_stream), patch(
+        "main.rate_limit_enabled", True
+    ), patch("main.query_limiter", limiter):
+        with client.websocket_connect(f"/ws/conversations/{convo.id}") as ws:
+            ws.send_json({"role": "user", "content": "x" * 40})
+            while ws.receive_json()["type"] != "done":
+                pass
+            # the first prompt used most of the bucket
+            ws.send_json({"role": "user", "content": "x" * 40})
+            error = ws.receive_json()
+            assert error["type"] == "error"
+            assert error["code"] == 429
+            assert error["retry_after"] >= 1
+
+    stored = await ConversationFull.get(convo.id)
+    assert len(stored.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_websocket_conversation_not_found(mongo_db):
+    with client.websocket_connect(f"/ws/conversations/{uuid4()}") as ws:
+        error = ws.receive_json()
+        assert error["type"] == "error"
+        assert error["code"] == 404
+
+
+@pytest.mark.asyncio
+async def test_session_cache_evicts_idle_sessions(mongo_db):
+    cache = ChatSessionCache(max_sessions=1)
+    first = ConversationFull(name="First", params={}, messages=[])
+    second = ConversationFull(name="Second", params={}, messages=[])
+    await first.insert()
+    await second.insert()
+
+    first_session = await cache.acquire(first.id)
+    second_session = await cache.acquire(second.id)
+    # both are connected, so nothing can be evicted yet
+    assert len(cache) == 2
+
+    cache.release(first_session)
+    assert len(cache) == 1
+    cache.release(second_session)
+    assert await cache.acquire(second.id) is second_session
@@ -0,0 +1,209 @@
+import asyncio
+from unittest.mock import patch
+import pytest
+from beanie import BulkWriter
+from pymongo.errors import AutoReconnect, BulkWriteError
+from models import ConversationFull, Prompt
+from writebehind import TurnWriter
+
+
+def make_turn(i):
+    return [Prompt(role="user", content=f"question {i}"), Prompt(role="assistant", content=f"answer {i}")]
+
+
+@pytest.mark.asyncio
+async def test_turns_are_coalesced_and_flushed(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True)
+
+    for i in range(3):
+        await writer.write(convo.id, make_turn(i), 5)
+    assert writer.metrics()["queue_depth"] == 1
+    assert writer.metrics()["pending_turns"] == 3
+
+    # not written yet, but reads see the queued turns
+    stored = await ConversationFull.get(convo.id)
+    assert stored.messages == []
+    writer.apply_pending(stored)
+    assert len(stored.messages) == 6
+    assert stored.tokens == 15
+
+    assert await writer.flush() == 1
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == [m.content for i in range(3) for m in make_turn(i)]
+    assert stored.tokens == 15
+    assert writer.metrics()["pending_turns"] == 0
+    assert writer.pending_messages(stored) == []
+
+
+@pytest.mark.asyncio
+async def test_reads_racing_a_flush_see_each_turn_once(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    # answered by Mongo before the flush, overlaid after it
+    before = await ConversationFull.get(convo.id)
+    await writer.flush()
+    after = await ConversationFull.get(convo.id)
+    await writer.write(convo.id, make_turn(1), 5)
+
+    expected = [m.content for i in range(2) for m in make_turn(i)]
+    for stored in (before, after):
+        writer.apply_pending(stored)
+        assert [m.content for m in stored.messages] == expected
+        assert stored.tokens == 10
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_turns_queued(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    with patch.object(BulkWriter, "commit", side_effect=Exception("Database error")):
+        with pytest.raises(Exception):
+            await writer.flush()
+    await writer.write(convo.id, make_turn(1), 5)
+    assert writer.metrics()["failed_flushes"] == 1
+    assert writer.metrics()["pending_turns"] == 2
+
+    await writer.drain()
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == [m.content for i in range(2) for m in make_turn(i)]
+
+
+@pytest.mark.asyncio
+async def test_flush_applied_before_an_error_is_not_applied_again(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    collection = ConversationFull.get_motor_collection()
+    bulk_write = collection.bulk_write
+
+    async def applied_then_raised(requests, **kwargs):
+        await bulk_write(requests, **kwargs)
+        raise AutoReconnect("connection closed")
+
+    with patch.object(collection, "bulk_write", side_effect=applied_then_raised):
+        with pytest.raises(AutoReconnect):
+            await writer.flush()
+    # queued after the failed flush, must not be folded into the batch that may already be stored
+    await writer.write(convo.id, make_turn(1), 5)
+
+    await writer.drain()
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == [m.content for i in range(2) for m in make_turn(i)]
+    assert stored.tokens == 10
+    assert stored.message_count == 4
+
+
+@pytest.mark.asyncio
+async def test_partially_failed_flush_requeues_only_the_failed_writes(mongo_db):
+    first = ConversationFull(name="First", params={}, messages=[])
+    second = ConversationFull(name="Second", params={}, messages=[])
+    await first.insert()
+    await second.insert()
+    writer = TurnWriter(enabled=True)
+    await writer.write(first.id, make_turn(0), 5)
+    await writer.write(second.id, make_turn(0), 5)
+
+    collection = ConversationFull.get_motor_collection()
+    bulk_write = collection.bulk_write
+
+    async def second_write_failed(requests, **kwargs):
+        await bulk_write(requests[:1], **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11600, "errmsg": "interrupted"}]})
+
+    with patch.object(collection, "bulk_write", side_effect=second_write_failed):
+        with pytest.raises(BulkWriteError):
+            await writer.flush()
+    assert writer.metrics()["queue_depth"] == 1
+    assert writer.metrics()["pending_turns"] == 1
+
+    assert await writer.flush() == 1
+    for convo in (first, second):
+        stored = await ConversationFull.get(convo.id)
+        assert [m.content for m in stored.messages] == [m.content for m in make_turn(0)]
+
+
+@pytest.mark.asyncio
+async def test_flush_cancelled_mid_write_is_requeued(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True, flush_interval=0.01)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    commit = BulkWriter.commit
+    committing = asyncio.Event()
+
+    async def slow_commit(self):
+        committing.set()
+        await asyncio.sleep(10)
+        return await commit(self)
+
+    with patch.object(BulkWriter, "commit", slow_commit):
+        task = asyncio.create_task(writer.run())
+        await committing.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    assert writer.metrics()["pending_turns"] == 1
+
+    await writer.drain()
+    stored = await ConversationFull.get(convo.id)
+    assert [m.content for m in stored.messages] == [m.content for m in make_turn(0)]
+
+
+@pytest.mark.asyncio
+async def test_stopped_writer_finishes_its_flush(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True, flush_interval=0.01)
+    task = asyncio.create_task(writer.run())
+    await asyncio.sleep(0)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    writer.stop()
+    await asyncio.wait_for(task, timeout=1)
+    stored = await ConversationFull.get(convo.id)
+    assert len(stored.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_durable_write_returns_once_flushed(mongo_db):
+    convo = ConversationFull(name="Write behind", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=True)
+
+    write = asyncio.create_task(writer.write(convo.id, make_turn(0), 5, durable=True))
+    await asyncio.sleep(0.01)
+    assert not write.done()
+    # a flush that fails leaves it waiting too
+    with patch.object(BulkWriter, "commit", side_effect=Exception("Database error")):
+        with pytest.raises(Exception):
+            await writer.flush()
+    await asyncio.sleep(0.01)
+    assert not write.done()
+
+    await writer.flush()
+    await asyncio.wait_for(write, timeout=1)
+    stored = await ConversationFull.get(convo.id)
+    assert len(stored.messages) == 2
+
+
+@pytest.mark.asyncio
+async def test_disabled_writer_writes_immediately(mongo_db):
+    convo = ConversationFull(name="Write through", params={}, messages=[])
+    await convo.insert()
+    writer = TurnWriter(enabled=False)
+    await writer.write(convo.id, make_turn(0), 5)
+
+    stored = await ConversationFull.get(convo.id)
+    assert len(stored.messages) == 2
+    assert writer.metrics()["queue_depth"] == 0
@@ -0,0 +1,300 @@
+'''
+Optional write-behind persistence for conversation turns. With it enabled, a turn is acknowledged as soon as
+it is queued in this process. Turns are coalesced per conversation and flushed to Mongo with one bulk_write
+when enough have built up or flush_interval has passed. Reads overlay the turns that are still queued, so
+clients always see their own writes.
+
+A flush can reach Mongo and still fail on our side (a dropped connection after the write), so every queued
+batch carries a flush id. The update only matches documents that have not recorded that id yet and records
+it, which makes retrying the batch safe. The same ids tell reads which queued turns a document they just read
+already holds: flushed batches stay visible for a few seconds, for reads that started before the flush.
+'''
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from uuid import UUID, uuid4
+
+from beanie import BulkWriter
+from pymongo.errors import BulkWriteError
+
+from models import ConversationFull, Prompt
+
+# flush ids remembered per conversation, far more than one conversation gets in FLUSHED_VISIBLE_SECONDS
+APPLIED_FLUSHES_KEPT = 50
+# how long flushed batches are still overlaid on reads that don't have them yet
+FLUSHED_VISIBLE_SECONDS = 5.0
+
+
+def now_ms() -> datetime:
+    # Mongo only keeps milliseconds, truncate so that in-memory and stored timestamps compare equal
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+@dataclass
+class PendingTurns:
+    messages: List[Prompt] = field(default_factory=list)
+    tokens: int = 0
+    turns: int = 0
+    updated_at: Optional[datetime] = None
+    queued_at: float = 0.0  # loop time the oldest turn was queued, for flush lag
+    flush_id: str = field(default_factory=lambda: uuid4().hex)
+    # set once a flush was attempted, Mongo may already hold it so newer turns are queued separately
+    sealed: bool = False
+    flushed_at: float = 0.0
+    # set once the batch is in Mongo, for writers that can't acknowledge before that
+    written: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def merge(self, newer: "PendingTurns"):
+        self.messages.extend(newer.messages)
+        self.tokens += newer.tokens
+        self.turns += newer.turns
+        self.updated_at = newer.updated_at
+
+
+class TurnWriter:
+    '''
+    Persists conversation turns, either directly or through the write-behind queue when enabled.
+      max_batch, flush as soon as this many conversations are queued
+      flush_interval, otherwise flush at least this often (seconds)
+      max_pending, once this many turns are queued, writers wait for a flush instead of queueing more
+    '''
+
+    def __init__(
+        self, enabled: bool = False, max_batch: int = 500, flush_interval: float = 0.05, max_pending: int = 10000
+    ):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # called with (id, messages) for every turn, e.g. to update the search index
+        self.listeners: List[Callable[[UUID, List[Prompt]], Awaitable[None]]] = []
+        self._pending: Dict[UUID, List[PendingTurns]] = {}
+        # batch currently being written, still visible to reads until the write succeeds
+        self._inflight: Dict[UUID, List[PendingTurns]] = {}
+        # written batches, for reads that were answered by Mongo before the write
+        self._flushed: Dict[UUID, List[PendingTurns]] = {}
+        self._pending_turns = 0
+        self._flush_lock = asyncio.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_batch_size = 0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+
+    def _event(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    async def write(self, id: UUID, messages: List[Prompt], tokens: int, durable: bool = False) -> datetime:
+        '''
+        Takes in: the conversation id, the messages of the new turn and the tokens it consumed. With durable,
+        only returns once the turn has been flushed, for callers that record the result elsewhere.
+        Returns: the updated_at timestamp recorded for the conversation
+        '''
+        updated_at = now_ms()
+        if not self.enabled:
+            await ConversationFull.find_one({"_id": id}).update(
+                {
+                    "$push": {ConversationFull.messages: {"$each": messages}},
+                    "$inc": {ConversationFull.tokens: tokens, ConversationFull.message_count: len(messages)},
+                    "$set": {ConversationFull.updated_at: updated_at},
+                }
+            )
+            await self._notify(id, messages)
+            return updated_at
+
+        if self._pending_turns >= self.max_pending:
+            # backpressure, Mongo is not keeping up
+            await self.flush()
+        turn = PendingTurns(
+            messages=list(messages),
+            tokens=tokens,
+            turns=1,
+            updated_at=updated_at,
+            queued_at=asyncio.get_running_loop().time(),
+        )
+        queued = self._pending.setdefault(id, [])
+        if queued and not queued[-1].sealed:
+            queued[-1].merge(turn)
+        else:
+            queued.append(turn)
+        batch = queued[-1]
+        self._pending_turns += 1
+        if len(self._pending) >= self.max_batch:
+            self._event().set()
+        await self._notify(id, messages)
+        if durable:
+            await batch.written.wait()
+        return updated_at
+
+    async def _notify(self, id: UUID, messages: List[Prompt]):
+        for listener in self.listeners:
+            try:
+                await listener(id, messages)
+            except Exception as e:
+                # the turn is already stored, a failing listener must not fail the request
+                print(f"An error occurred in a turn listener: {e}")
+
+    def _queued(self, convo) -> List[PendingTurns]:
+        '''
+        Returns: the batches for convo that it does not hold yet, going by the flush ids it has applied.
+        convo is the document or a projection of one that includes applied_flushes, as read from Mongo.
+        '''
+        applied = set(getattr(convo, "applied_flushes", None) or ())
+        queued = self._flushed.get(convo.id, []) + self._inflight.get(convo.id, []) + self._pending.get(convo.id, [])
+        return [p for p in queued if p.flush_id not in applied]
+
+    def pending_messages(self, convo) -> List[Prompt]:
+        return [m for p in self._queued(convo) for m in p.messages]
+
+    def pending_updated_at(self, convo) -> Optional[datetime]:
+        queued = self._queued(convo)
+        return queued[-1].updated_at if queued else None
+
+    def apply_pending(self, convo):
+        '''
+        Overlays queued turns onto a conversation (or a projection of one) that was just read from Mongo.
+        Read paths only, like archive.hydrate.
+        '''
+        for pending in self._queued(convo):
+            if getattr(convo, "messages", None) is not None:
+                convo.messages = list(convo.messages) + pending.messages
+            if getattr(convo, "tokens", None) is not None:
+                convo.tokens += pending.tokens
+            if hasattr(convo, "updated_at"):
+                convo.updated_at = pending.updated_at
+        return convo
+
+    async def flush(self) -> int:
+        '''
+        Writes everything queued so far in one bulk_write. Returns the number of conversations written.
+        On failure the unwritten part of the batch is put back in front of anything queued since, and the
+        error is raised.
+        '''
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+            operations: List[Tuple[UUID, PendingTurns]] = [(id, p) for id, queued in batch.items() for p in queued]
+            turns = sum(p.turns for _, p in operations)
+            self._pending_turns -= turns
+            oldest = min(p.queued_at for _, p in operations)
+            failed_from = len(operations)
+            try:
+                bulk_writer = BulkWriter()
+                for id, pending in operations:
+                    pending.sealed = True
+                    await ConversationFull.find_one(
+                        {"_id": id, "applied_flushes": {"$ne": pending.flush_id}}
+                    ).update(
+                        {
+                            "$push": {
+                                ConversationFull.messages: {"$each": pending.messages},
+                                ConversationFull.applied_flushes: {
+                                    "$each": [pending.flush_id],
+                                    "$slice": -APPLIED_FLUSHES_KEPT,
+                                },
+                            },
+                            "$inc": {
+                                ConversationFull.tokens: pending.tokens,
+                                ConversationFull.message_count: len(pending.messages),
+                            },
+                            "$set": {ConversationFull.updated_at: pending.updated_at},
+                        },
+                        bulk_writer=bulk_writer,
+                    )
+                await bulk_writer.commit()
+            except BaseException as e:
+                # including cancellation, the batch may be half written but must not be dropped
+                self.failed_flushes += 1
+                failed_from = 0
+                if isinstance(e, BulkWriteError):
+                    # the bulk write is ordered, everything before the first failed operation was applied
+                    errors = e.details.get("writeErrors") or [{"index": 0}]
+                    failed_from = min(error["index"] for error in errors)
+                # anything else may or may not have been applied, the flush ids make retrying it safe
+                requeued: Dict[UUID, List[PendingTurns]] = {}
+                for id, pending in operations[failed_from:]:
+                    requeued.setdefault(id, []).append(pending)
+                    self._pending_turns += pending.turns
+                for id, queued in self._pending.items():
+                    requeued.setdefault(id, []).extend(queued)
+                self._pending = requeued
+                raise
+            finally:
+                # moved before _inflight is cleared, so there is no point at which a batch isn't visible
+                self._keep_visible(operations[:failed_from])
+                self._inflight = {}
+
+            self.flushes += 1
+            self.last_batch_size = len(batch)
+            self.last_flush_lag = asyncio.get_running_loop().time() - oldest
+            self.max_flush_lag = max(self.max_flush_lag, self.last_flush_lag)
+            return len(batch)
+
+    def _keep_visible(self, written: List[Tuple[UUID, PendingTurns]]):
+        now = asyncio.get_running_loop().time()
+        for id, pending in written:
+            pending.flushed_at = now
+            pending.written.set()
+            self._flushed.setdefault(id, []).append(pending)
+        for id in list(self._flushed):
+            visible = [p for p in self._flushed[id] if now - p.flushed_at < FLUSHED_VISIBLE_SECONDS]
+            if visible:
+                self._flushed[id] = visible
+            else:
+                del self._flushed[id]
+
+    def stop(self):
+        '''
+        Makes run() return after the flush it is in, if any. Cancelling run() instead would interrupt a write.
+        '''
+        self._stopping = True
+        self._event().set()
+
+    async def run(self):
+        wakeup = self._event()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"An error occurred while flushing conversation turns: {e}")
+
+    async def drain(self, attempts: int = 5):
+        '''
+        Flushes until the queue is empty, used on shutdown so that acknowledged turns are not lost.
+        '''
+        for _ in range(attempts):
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"An error occurred while draining conversation turns: {e}")
+                await asyncio.sleep(self.flush_interval)
+            if not self._pending:
+                return
+        print(f"Could not drain {self._pending_turns} queued conversation turns")
+
+    def metrics(self) -> dict:
+        oldest = min((queued[0].queued_at for queued in self._pending.values()), default=None)
+        lag = asyncio.get_running_loop().time() - oldest if oldest is not None else 0.0
+        return {
+            "queue_depth": len(self._pending),
+            "pending_turns": self._pending_turns,
+            "oldest_pending_seconds": lag,
+            "last_flush_lag_seconds": self.last_flush_lag,
+            "max_flush_lag_seconds": self.max_flush_lag,
+            "last_batch_size": self.last_batch_size,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+        }